@@ -0,0 +1,281 @@
+"""
+micro-benchmarks comparing implementations of the same functionality
+"""
+import os
+import shutil
+import tempfile
+from time import time
+
+import numpy as np
+
+from boomlet import parallel
+from boomlet import storage
+from boomlet.utils.heap import Heap, IndexedHeap, ConstSizeHeap, TopK
+from boomlet.utils.collection import group_by, GroupBy
+from boomlet.settings import PARALLEL
+
+
+def time_per_call(func, n_calls=10):
+    """ average wall time of calling a function with no arguments, after one warm up call
+    """
+    func()
+    start_time = time()
+    for _ in range(n_calls):
+        func()
+    return (time() - start_time) / n_calls
+
+
+def pmap_overhead(n_calls=20, n_items=32):
+    """ per-call overhead of pmap with and without the persistent worker pool, for both a picklable function and an unpicklable closure
+    """
+    offset = 1
+
+    def closure(x):
+        return x + offset
+
+    funcs = dict(pickle=abs, no_pickle=closure)
+    old_pool = PARALLEL.POOL
+    results = {}
+    try:
+        for pool in (False, True):
+            PARALLEL.POOL = pool
+            for name, func in funcs.items():
+                key = (name, "pool" if pool else "no pool")
+                results[key] = time_per_call(lambda: parallel.pmap(func, range(n_items)), n_calls)
+                print("{}: {}s per call".format(key, results[key]))
+    finally:
+        PARALLEL.POOL = old_pool
+    return results
+
+
+def pmap_chunking(n_items=100000, chunk_sizes=(1, None)):
+    """ time of a pmap over many tiny tasks with fixed and automatically picked chunk sizes
+    """
+    old_chunk_size = PARALLEL.CHUNK_SIZE
+    results = {}
+    try:
+        for chunk_size in chunk_sizes:
+            PARALLEL.CHUNK_SIZE = chunk_size
+            results[chunk_size] = time_per_call(lambda: parallel.pmap(abs, range(n_items)), 1)
+            print("chunk size {}: {}s".format(chunk_size, results[chunk_size]))
+    finally:
+        PARALLEL.CHUNK_SIZE = old_chunk_size
+    return results
+
+
+def pmap_backends(n_items=16, size=500):
+    """ time of a pmap over BLAS-bound tasks sharing a large array with the thread backend, the pooled process backend, and the per-call process backends
+    """
+    A = np.random.randn(size, size)
+
+    def blas_task(i):
+        return np.linalg.norm(np.dot(A, A.T) + i)
+
+    old_pool = PARALLEL.POOL
+    results = {}
+    try:
+        for name, backend, pool in [("thread", "thread", True),
+                                    ("process pool", "process", True),
+                                    ("process per call", "process", False)]:
+            PARALLEL.POOL = pool
+            with parallel.use_backend(backend):
+                results[name] = time_per_call(lambda: parallel.pmap(blas_task, range(n_items)), 3)
+            print("{}: {}s per call".format(name, results[name]))
+    finally:
+        PARALLEL.POOL = old_pool
+    return results
+
+
+def compression(n_bytes=int(5e7), levels=(1, 6, 9), threads=(1, None)):
+    """ throughput and compression ratio of single-string zlib against the chunked format with one and with all available threads, on a pickled array of small integers
+    """
+    s = storage.pickle_dumps(np.random.randint(0, 100, n_bytes // 8))
+    results = {}
+    for level in levels:
+        candidates = [("zlib", lambda: storage.compress(s, level))]
+        for n_threads in threads:
+            candidates.append(("chunked, {} threads".format(n_threads or "all"),
+                               lambda n_threads=n_threads: storage.compress_chunked(s, level, threads=n_threads)))
+        for name, func in candidates:
+            seconds = time_per_call(func, 1)
+            ratio = float(len(s)) / len(func())
+            key = (name, level)
+            results[key] = (len(s) / seconds / 1e6, ratio)
+            print("{}, level {}: {:.1f}MB/s, ratio {:.2f}".format(name, level, results[key][0], ratio))
+    return results
+
+
+def model_loading(n_models=200, n_features=10000):
+    """ time to load an ensemble of linear models with pickle_load and memory-mapped with model_load
+    """
+    from sklearn.linear_model import Ridge
+    from boomlet.meta.sampling import RowSampler
+
+    X = np.random.randn(100, n_features)
+    y = np.random.randn(100)
+    clf = RowSampler(Ridge(), n_iter=n_models).fit(X, y)
+    folder = tempfile.mkdtemp()
+    pickle_filename = os.path.join(folder, "model.pkl")
+    model_dirname = os.path.join(folder, "model")
+    try:
+        storage.pickle_dump(pickle_filename, clf)
+        storage.model_dump(model_dirname, clf)
+        results = dict(
+            pickle=time_per_call(lambda: storage.pickle_load(pickle_filename)),
+            model=time_per_call(lambda: storage.model_load(model_dirname)),
+        )
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    for name, seconds in results.items():
+        print("{}: {}s per load".format(name, seconds))
+    return results
+
+
+def heap_updates(sizes=(10 ** 5, 10 ** 6), n_updates=100):
+    """ time per key update of random items of a Heap, which has to find the index of an item first, and of an IndexedHeap
+    """
+    results = {}
+    for size in sizes:
+        keys = np.random.rand(size).tolist()
+        updated = np.random.randint(0, size, n_updates).tolist()
+        new_keys = np.random.rand(n_updates).tolist()
+
+        heap = Heap(list(range(size)), key=lambda item: keys[item], mutable=True)
+
+        def update_heap():
+            for item, new_key in zip(updated, new_keys):
+                index = heap.index(item)
+                keys[item] = new_key
+                heap.modify_key(index, new_key)
+
+        indexed_heap = IndexedHeap(list(range(size)), key=lambda item: keys[item])
+
+        def update_indexed_heap():
+            for item, new_key in zip(updated, new_keys):
+                indexed_heap.update_key(item, new_key)
+
+        for name, func in [("Heap", update_heap), ("IndexedHeap", update_indexed_heap)]:
+            results[(name, size)] = time_per_call(func, 1) / n_updates
+            print("{}, {} items: {}s per update".format(name, size, results[(name, size)]))
+    return results
+
+
+def top_k(n_items=10 ** 5, max_size=32):
+    """ time to keep the best scored items out of many with ConstSizeHeap and TopK, pushing one at a time and all at once
+    """
+    scores = np.random.rand(n_items).tolist()
+    items = [[i] for i in range(n_items)]
+
+    def push_one_at_a_time(container):
+        for item in zip(scores, items):
+            container.push(item)
+        return container.to_list()
+
+    candidates = [
+        ("ConstSizeHeap push", lambda: push_one_at_a_time(ConstSizeHeap(max_size))),
+        ("TopK push", lambda: push_one_at_a_time(TopK(max_size))),
+        ("TopK push_many", lambda: TopK(max_size).push_many(scores, items)),
+    ]
+    results = {}
+    for name, func in candidates:
+        results[name] = time_per_call(func, 3)
+        print("{}: {}s".format(name, results[name]))
+    return results
+
+
+def group_by_reductions(n_rows=10 ** 6, n_keys=1000, reductions=("mean", "median", "mode")):
+    """ time to reduce values by key with group_by over enumerated rows, as DiscreteConstantPredictor used to, and with GroupBy
+    """
+    from boomlet.utils.aggregators import from_str
+
+    keys = np.random.randint(0, n_keys, n_rows)
+    values = np.random.randint(0, 10, n_rows).astype(float)
+
+    def with_group_by(name):
+        aggregator = from_str(name)
+        grouped = group_by(list(enumerate(values)), lambda i: keys[i[0]])
+        return dict((k, aggregator(np.array([i[1] for i in v])))
+                    for k, v in grouped.items())
+
+    results = {}
+    for name in reductions:
+        for impl, func in [("group_by", lambda: with_group_by(name)),
+                           ("GroupBy", lambda: GroupBy(keys).aggregate(values, name))]:
+            results[(impl, name)] = time_per_call(func, 1)
+            print("{} {}: {}s".format(impl, name, results[(impl, name)]))
+    return results
+
+
+def median_trick(sample_sizes=(1000, 4000), n_features=50, max_bytes=1e7):
+    """ time and bandwidth of the median trick with the full distance matrix, as gaussian_kernel_median_trick used to compute it, and with distance tiles of at most max_bytes
+    """
+    from boomlet.utils.estimators import gaussian_kernel_median_trick
+
+    X = np.random.randn(max(sample_sizes), n_features)
+
+    def full_matrix(sample):
+        norms = np.sum(sample ** 2, axis=1).reshape(-1, 1)
+        tmp = np.dot(norms, np.ones((1, sample.shape[0])))
+        dist = tmp + tmp.T - 2 * np.dot(sample, sample.T)
+        return 1 / np.sqrt(np.median(dist))
+
+    results = {}
+    for sample_size in sample_sizes:
+        sample = X[:sample_size]
+        for impl, func in [("full", lambda: full_matrix(sample)),
+                           ("blocked", lambda: gaussian_kernel_median_trick(
+                               sample, None, max_bytes=max_bytes))]:
+            start_time = time()
+            scale = func()
+            results[(impl, sample_size)] = (time() - start_time, scale)
+            print("{} {}: {}s, scale {}".format(impl, sample_size, *results[(impl, sample_size)]))
+    return results
+
+
+def gini_metrics(n_rows=10 ** 6, chunk_size=10 ** 5):
+    """ time of the gini coefficients with the loop over sorted values and the Counter that boomlet.metrics used, vectorized, and of all metrics over chunks of memmaps
+    """
+    from collections import Counter
+    from boomlet import metrics
+
+    def loop_gini_coefficient(x):
+        sorted_x = sorted(x)
+        len_x = len(x)
+        tot = 0.0
+        for i, xi in enumerate(sorted_x):
+            added = i
+            subtracted = len_x - i - 1
+            tot += (added - subtracted) * xi
+        return tot / (len_x ** 2)
+
+    def counter_categorical_gini_coefficient(x):
+        len_x = len(x)
+        counter = Counter(x)
+        total = 0.0
+        for _, count in counter.items():
+            total += len_x - count
+        return total / (len_x ** 2)
+
+    y_true = np.random.randn(n_rows)
+    pred = y_true + np.random.randn(n_rows)
+    labels = np.random.randint(0, 10, n_rows)
+    folder = tempfile.mkdtemp()
+    try:
+        filenames = [os.path.join(folder, name) for name in ("y_true.npy", "pred.npy")]
+        for filename, data in zip(filenames, [y_true, pred]):
+            np.save(filename, data)
+        mmaps = [np.load(filename, mmap_mode='r') for filename in filenames]
+        candidates = [
+            ("loop gini_coefficient", lambda: loop_gini_coefficient(y_true)),
+            ("gini_coefficient", lambda: metrics.gini_coefficient(y_true)),
+            ("Counter categorical_gini_coefficient", lambda: counter_categorical_gini_coefficient(labels)),
+            ("categorical_gini_coefficient", lambda: metrics.categorical_gini_coefficient(labels)),
+            ("chunked_metrics", lambda: metrics.chunked_metrics(mmaps[0], mmaps[1], chunk_size, max_elements=chunk_size)),
+        ]
+        results = {}
+        for name, func in candidates:
+            results[name] = time_per_call(func, 1)
+            print("{}: {}s".format(name, results[name]))
+    finally:
+        shutil.rmtree(folder)
+    return results
@@ -0,0 +1,416 @@
+"""
+"cluster" backend for parallel maps, that runs tasks on worker processes connected over TCP, which may be on other machines
+
+the process running the map serves a Coordinator through multiprocessing.managers; workers are started with:
+
+    BOOMLET_CLUSTER_AUTHKEY=KEY python -m boomlet.cluster HOST PORT [CORES]
+
+where KEY is PARALLEL.CLUSTER_AUTHKEY, or the random key of get_authkey() if it is not set; clients with the key can run code on the coordinator, which only listens on other interfaces than loopback with an explicit key
+
+workers send heartbeats, and the tasks of workers without a heartbeat for PARALLEL.CLUSTER_TIMEOUT seconds are sent to other workers
+"""
+import os
+import sys
+import socket
+import binascii
+import atexit
+import itertools
+import threading
+import multiprocessing
+from time import time
+from collections import deque
+from multiprocessing.managers import BaseManager
+
+from boomlet.settings import PARALLEL, INSTRUMENT
+from boomlet.decorators import METRICS
+from boomlet.storage import ArrayFolder
+from boomlet import parallel
+
+# arrays can't be shared through files with other machines, so everything
+# is serialized inline
+_INLINE = ArrayFolder(None, float("inf"))
+
+
+class Coordinator(object):
+
+    """ board of tasks shared with workers, living in the process that runs parallel maps
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.worker_ids = itertools.count()
+        self.task_ids = itertools.count()
+        self.heartbeats = {}
+        self.funcs = {}
+        self.tasks = {}
+        self.pending = deque()
+        self.assigned = {}
+        self.results = {}
+        self.closed = False
+        self.waiting = 0
+
+    # methods called by workers
+
+    def register(self):
+        with self.condition:
+            worker_id = next(self.worker_ids)
+            self.heartbeats[worker_id] = time()
+            return worker_id
+
+    def heartbeat(self, worker_id):
+        """ returns False if the worker was presumed dead, in which case it should register again
+        """
+        with self.condition:
+            if worker_id not in self.heartbeats:
+                return False
+            self.heartbeats[worker_id] = time()
+            return True
+
+    def get_func(self, map_id):
+        """ returns the serialized function of a map and whether functions are instrumented, or None if the map was removed
+        """
+        return self.funcs.get(map_id)
+
+    def get_task(self, worker_id, timeout):
+        """ returns a (task id, map id, serialized items) triple, or None if there was no task within the timeout
+        """
+        with self.condition:
+            deadline = time() + timeout
+            self.waiting += 1
+            try:
+                while not self.pending:
+                    remaining = deadline - time()
+                    if remaining <= 0 or self.closed:
+                        return None
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            task_id = self.pending.popleft()
+            self.assigned[task_id] = worker_id
+            map_id, items_s = self.tasks[task_id]
+            return task_id, map_id, items_s
+
+    def put_result(self, worker_id, task_id, result):
+        with self.condition:
+            # results of tasks that were already finished by another
+            # worker are ignored
+            if task_id in self.tasks:
+                map_id, _ = self.tasks.pop(task_id)
+                self.assigned.pop(task_id, None)
+                self.results[task_id] = (map_id, result)
+                self.condition.notify_all()
+
+    # methods called by the process running the map
+
+    def add_map(self, map_id, func_s, instrumented):
+        with self.condition:
+            self.funcs[map_id] = (func_s, instrumented)
+
+    def remove_map(self, map_id):
+        """ forgets a map along with its unfinished tasks and results that were not waited for
+        """
+        with self.condition:
+            self.funcs.pop(map_id, None)
+            for task_id, (result_map_id, _) in list(self.results.items()):
+                if result_map_id == map_id:
+                    del self.results[task_id]
+            for task_id, (task_map_id, _) in list(self.tasks.items()):
+                if task_map_id == map_id:
+                    del self.tasks[task_id]
+                    self.assigned.pop(task_id, None)
+            self.pending = deque(task_id for task_id in self.pending
+                                 if task_id in self.tasks)
+
+    def submit(self, map_id, items_s):
+        with self.condition:
+            task_id = next(self.task_ids)
+            self.tasks[task_id] = (map_id, items_s)
+            self.pending.append(task_id)
+            self.condition.notify_all()
+            return task_id
+
+    def requeue_dead(self):
+        """ forgets workers without a recent heartbeat and sends their tasks to other workers
+        """
+        with self.condition:
+            now = time()
+            dead = set(worker_id for worker_id, last in self.heartbeats.items()
+                       if now - last > self.timeout)
+            for worker_id in dead:
+                del self.heartbeats[worker_id]
+            for task_id, worker_id in list(self.assigned.items()):
+                if worker_id in dead:
+                    del self.assigned[task_id]
+                    self.pending.appendleft(task_id)
+            if dead:
+                self.condition.notify_all()
+            return dead
+
+    def wait_any(self, task_ids, poll):
+        """ returns a (task id, result) pair of a finished task among task_ids, checking for dead workers every poll seconds
+        """
+        with self.condition:
+            while True:
+                for task_id in task_ids:
+                    if task_id in self.results:
+                        return task_id, self.results.pop(task_id)[1]
+                self.condition.wait(poll)
+                self.requeue_dead()
+
+    def n_workers(self):
+        return len(self.heartbeats)
+
+    def close(self, timeout=1.0):
+        """ releases workers waiting for tasks, waiting up to a timeout for them to be released
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+            deadline = time() + timeout
+            while self.waiting and time() < deadline:
+                self.condition.wait(0.01)
+
+
+class _DriverManager(BaseManager):
+    pass
+
+
+class _WorkerManager(BaseManager):
+    pass
+
+
+_DriverManager.register("get_coordinator", callable=lambda: _COORDINATOR)
+_WorkerManager.register("get_coordinator")
+
+_COORDINATOR = None
+_SERVER = None
+_AUTHKEY = None
+_LOCK = threading.Lock()
+_MAP_IDS = itertools.count()
+_LOCAL_WORKERS = []
+
+
+def _is_loopback(host):
+    try:
+        return host == "::1" or socket.gethostbyname(host).startswith("127.")
+    except socket.error:
+        return False
+
+
+def start_server(address=None, authkey=None):
+    """ starts serving the coordinator in a background thread of this process (if not already started), returning the address it listens on
+
+    without an authkey (or PARALLEL.CLUSTER_AUTHKEY), a random key is generated, which is only allowed for loopback addresses
+    """
+    global _COORDINATOR, _SERVER, _AUTHKEY
+    with _LOCK:
+        if _SERVER is None:
+            if address is None:
+                address = PARALLEL.CLUSTER_ADDRESS
+            if authkey is None:
+                authkey = PARALLEL.CLUSTER_AUTHKEY
+            if authkey is None:
+                if not _is_loopback(address[0]):
+                    raise Exception("Improper cluster authkey: PARALLEL.CLUSTER_AUTHKEY must be set to listen on {}".format(address[0] or "all interfaces"))
+                authkey = binascii.hexlify(os.urandom(16))
+            _COORDINATOR = Coordinator(PARALLEL.CLUSTER_TIMEOUT)
+            manager = _DriverManager(address=address, authkey=authkey)
+            _SERVER = manager.get_server()
+            _AUTHKEY = authkey
+            thread = threading.Thread(target=_SERVER.serve_forever)
+            thread.daemon = True
+            thread.start()
+        return _SERVER.address
+
+
+def get_authkey():
+    """ key that workers must connect to the coordinator with
+    """
+    start_server()
+    return _AUTHKEY
+
+
+def get_coordinator():
+    start_server()
+    return _COORDINATOR
+
+
+def cluster_map(func, generator):
+    """ parallel map over the workers connected to the coordinator, returning results in order
+
+    items are sent in chunks of PARALLEL.CHUNK_SIZE (default: 1), and the map waits for workers to connect if there are none
+    """
+    return list(cluster_imap(func, generator))
+
+
+def cluster_imap(func, generator, ordered=True):
+    """ generator of the results of a parallel map over the workers connected to the coordinator, that only reads from the input generator as results are consumed
+
+    at most PARALLEL.MAX_IN_FLIGHT chunks per connected worker (or in total, while no worker is connected) are submitted but not yet yielded; when ordered is False, results are yielded as soon as they finish
+    """
+    coordinator = get_coordinator()
+    map_id = next(_MAP_IDS)
+    coordinator.add_map(map_id, _INLINE.dumps(func, use_dill=True), INSTRUMENT.ENABLED)
+    try:
+        items = iter(generator)
+        chunk_size = PARALLEL.CHUNK_SIZE or 1
+        exhausted = False
+        # submitted tasks, in order, whose results were not yielded
+        in_flight = []
+        while True:
+            while (not exhausted and len(in_flight)
+                   < PARALLEL.MAX_IN_FLIGHT * max(coordinator.n_workers(), 1)):
+                chunk = list(itertools.islice(items, chunk_size))
+                if not chunk:
+                    exhausted = True
+                    break
+                items_s = [parallel._dumps_item(_INLINE, item) for item in chunk]
+                in_flight.append(coordinator.submit(map_id, items_s))
+            if not in_flight:
+                return
+            task_id, (success, result) = coordinator.wait_any(
+                in_flight[:1] if ordered else in_flight,
+                PARALLEL.CLUSTER_HEARTBEAT)
+            in_flight.remove(task_id)
+            if not success:
+                raise result
+            if result[3]:
+                METRICS.merge(result[3])
+            for item_result in result[0]:
+                yield item_result
+    finally:
+        coordinator.remove_map(map_id)
+
+
+def _reset():
+    """ forgets the coordinator and local workers inherited from the parent in a forked process
+    """
+    global _COORDINATOR, _SERVER, _AUTHKEY, _LOCK
+    _COORDINATOR = _SERVER = _AUTHKEY = None
+    _LOCK = threading.Lock()
+    del _LOCAL_WORKERS[:]
+
+
+def _local_backend():
+    # maps within tasks run on the worker instead of the cluster it is part of
+    return "process" if PARALLEL.BACKEND == "cluster" else PARALLEL.BACKEND
+
+
+def _heartbeat(coordinator, worker_id, stop):
+    while not stop.wait(PARALLEL.CLUSTER_HEARTBEAT):
+        try:
+            coordinator.heartbeat(worker_id)
+        except (EOFError, IOError, socket.error):
+            return
+
+
+def _start_heartbeat(coordinator, worker_id):
+    """ starts a thread sending heartbeats for a worker id, returning the event that stops it
+    """
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(coordinator, worker_id, stop))
+    heartbeat.daemon = True
+    heartbeat.start()
+    return stop
+
+
+def run_worker(address, authkey=None, n_cores=None):
+    """ runs tasks from the coordinator at an address until it goes away
+
+    n_cores is the core budget of parallel maps within the tasks (default: PARALLEL.JOBS), which run on this worker with PARALLEL.BACKEND, or with processes if it is "cluster"
+    """
+    if authkey is None:
+        authkey = PARALLEL.CLUSTER_AUTHKEY
+    if authkey is None and "BOOMLET_CLUSTER_AUTHKEY" in os.environ:
+        authkey = os.environ["BOOMLET_CLUSTER_AUTHKEY"].encode()
+    if authkey is None:
+        raise Exception("Improper cluster authkey: set PARALLEL.CLUSTER_AUTHKEY or BOOMLET_CLUSTER_AUTHKEY")
+    # local workers are forked from the process running the map
+    parallel._init_worker()
+    manager = _WorkerManager(address=address, authkey=authkey)
+    manager.connect()
+    coordinator = manager.get_coordinator()
+    worker_id = coordinator.register()
+    stop = _start_heartbeat(coordinator, worker_id)
+    funcs = {}
+    try:
+        while True:
+            try:
+                task = coordinator.get_task(worker_id, PARALLEL.CLUSTER_HEARTBEAT)
+                if task is None:
+                    if not coordinator.heartbeat(worker_id):
+                        # presumed dead, e.g. after a pause longer than
+                        # PARALLEL.CLUSTER_TIMEOUT
+                        stop.set()
+                        worker_id = coordinator.register()
+                        stop = _start_heartbeat(coordinator, worker_id)
+                    continue
+                task_id, map_id, items_s = task
+                if map_id not in funcs:
+                    entry = coordinator.get_func(map_id)
+                    if entry is None:
+                        # the map was removed after the task was taken
+                        continue
+                    func_s, instrumented = entry
+                    try:
+                        func = _INLINE.loads(func_s, use_dill=True)
+                    except Exception as e:
+                        # e.g. a module missing on this worker; the map
+                        # fails instead of the worker
+                        coordinator.put_result(worker_id, task_id, (False, e))
+                        continue
+                    # only the function of the current map is kept
+                    funcs.clear()
+                    funcs[map_id] = (func, instrumented)
+                func, instrumented = funcs[map_id]
+                items = (parallel._loads_item(_INLINE, item_s) for item_s in items_s)
+                with parallel.cores(n_cores), parallel.use_backend(_local_backend()):
+                    result = parallel._call_chunk(func, items, instrumented=instrumented)
+                coordinator.put_result(worker_id, task_id, result)
+            except (EOFError, IOError, socket.error):
+                # the coordinator went away
+                return
+    finally:
+        stop.set()
+
+
+def start_local_workers(n, address=None, authkey=None):
+    """ starts a number of worker processes on this machine, connected to the coordinator of this process, returning the processes
+    """
+    host, port = start_server(address, authkey)
+    if host in ("", "0.0.0.0"):
+        host = "localhost"
+    processes = []
+    for _ in range(n):
+        process = multiprocessing.Process(target=run_worker, args=((host, port), _AUTHKEY, 1))
+        process.daemon = True
+        process.start()
+        processes.append(process)
+    _LOCAL_WORKERS.extend(processes)
+    return processes
+
+
+def _shutdown_server():
+    global _SERVER, _COORDINATOR, _AUTHKEY
+    if _COORDINATOR is not None:
+        _COORDINATOR.close()
+    for process in _LOCAL_WORKERS:
+        process.terminate()
+        process.join()
+    del _LOCAL_WORKERS[:]
+    if _SERVER is not None:
+        try:
+            _SERVER.listener.close()
+        except Exception:
+            pass
+    _SERVER = _COORDINATOR = _AUTHKEY = None
+
+
+atexit.register(_shutdown_server)
+
+
+if __name__ == "__main__":
+    host, port = sys.argv[1], int(sys.argv[2])
+    n_cores = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    run_worker((host, port), n_cores=n_cores)
@@ -1,9 +1,27 @@
 from time import time
 from contextlib import contextmanager
+from collections import OrderedDict
 import random
+import hashlib
+import numbers
+import threading
 
 import numpy as np
 
+try:
+    from time import perf_counter, process_time
+except ImportError:
+    # python 2: clock is the processor time on unix
+    from timeit import default_timer as perf_counter
+    from time import clock as process_time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from boomlet.utils import memory
+
 @contextmanager
 def timer(name=""):
     start_time = time()
@@ -18,7 +36,7 @@ def seed_random(seed=None):
     """
     if seed is None:
         yield
-    elif isinstance(seed, int):
+    elif isinstance(seed, numbers.Integral):
         # save state
         random_state = random.getstate()
         np_random_state = np.random.get_state()
@@ -31,3 +49,163 @@ def seed_random(seed=None):
         np.random.set_state(np_random_state)
     else:
         raise TypeError("Improper random seed type")
+
+
+def spawn_seeds(seed, n):
+    """
+    derives n seeds from a root seed (any object with a stable str, such as
+    an int or a tuple of ints), such that the random streams they seed are
+    reproducible and independent of each other, e.g. for the items of a
+    parallel map; returns Nones if the root seed is None
+    """
+    if seed is None:
+        return [None] * n
+    return [int(hashlib.md5("{}:{}".format(seed, i).encode()).hexdigest()[:8], 16)
+            for i in range(n)]
+
+
+def _memory():
+    """ current and peak bytes of memory traced by tracemalloc if it is tracing, else of resident memory
+    """
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()
+    return memory.current_rss(), memory.peak_rss()
+
+
+def _reset_peak_memory():
+    if (tracemalloc is not None and tracemalloc.is_tracing()
+            and hasattr(tracemalloc, "reset_peak")):
+        tracemalloc.reset_peak()
+    else:
+        memory.reset_peak_rss()
+
+
+class Span(object):
+
+    """ statistics of the spans with the same name within the same parent span, aggregated over the times they ran
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.wall = 0.0
+        self.min_wall = float("inf")
+        self.max_wall = 0.0
+        self.cpu = 0.0
+        self.peak_memory = 0
+        self.children = OrderedDict()
+
+    def child(self, name):
+        if name not in self.children:
+            self.children[name] = Span(name)
+        return self.children[name]
+
+    def add(self, wall, cpu, peak_memory):
+        self.count += 1
+        self.wall += wall
+        self.min_wall = min(self.min_wall, wall)
+        self.max_wall = max(self.max_wall, wall)
+        self.cpu += cpu
+        self.peak_memory = max(self.peak_memory, peak_memory)
+
+    def to_dict(self):
+        return dict(name=self.name,
+                    count=self.count,
+                    wall=self.wall,
+                    min_wall=self.min_wall,
+                    max_wall=self.max_wall,
+                    cpu=self.cpu,
+                    peak_memory=self.peak_memory,
+                    children=[child.to_dict() for child in self.children.values()])
+
+    def report(self):
+        """ table of the tree of spans, with the wall time of each span as a percentage of its parent's
+        """
+        lines = ["{:<40}{:>7}{:>10}{:>10}{:>10}{:>10}{:>11}{:>8}".format(
+            "span", "count", "wall(s)", "mean(s)", "max(s)", "cpu(s)", "peak(MB)", "%")]
+        self._report(lines, 0, self.wall)
+        return "\n".join(lines)
+
+    def _report(self, lines, depth, parent_wall):
+        lines.append("{:<40}{:>7}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}{:>11.1f}{:>7.1f}%".format(
+            "  " * depth + self.name,
+            self.count,
+            self.wall,
+            self.wall / max(self.count, 1),
+            self.max_wall,
+            self.cpu,
+            self.peak_memory / 1e6,
+            100.0 * self.wall / parent_wall if parent_wall else 100.0))
+        for child in self.children.values():
+            child._report(lines, depth + 1, self.wall)
+
+# stacks of [span, start wall time, start cpu time, start memory, peak memory]
+# of the running spans of each thread
+_SPANS = threading.local()
+
+
+def _start_span(node):
+    stack = _SPANS.stack
+    if stack:
+        # the peak of the parent is saved before it is reset for the child
+        parent = stack[-1]
+        parent[4] = max(parent[4], _memory()[1])
+    _reset_peak_memory()
+    stack.append([node, perf_counter(), process_time(), _memory()[0], 0])
+
+
+def _end_span():
+    node, start_wall, start_cpu, start_memory, peak = _SPANS.stack.pop()
+    peak = max(peak, _memory()[1])
+    node.add(perf_counter() - start_wall, process_time() - start_cpu, peak - start_memory)
+    if _SPANS.stack:
+        parent = _SPANS.stack[-1]
+        parent[4] = max(parent[4], peak)
+
+
+@contextmanager
+def span(name):
+    """
+    records the wall time, processor time and peak memory of a block as a
+    child of the running span, if a profile is running in this thread
+
+    peak memory is from tracemalloc if it is tracing, else of resident
+    memory (which can only be reset on linux)
+    """
+    stack = getattr(_SPANS, "stack", None)
+    if not stack:
+        yield
+        return
+    _start_span(stack[-1][0].child(name))
+    try:
+        yield
+    finally:
+        _end_span()
+
+
+@contextmanager
+def profile(name="profile", report=True):
+    """
+    records spans within a block into a tree of Span, printing a report of
+    it at the end
+
+    Example:
+
+    with profile() as root:
+        FitClusterer().fit(X)
+    root.to_dict()
+    """
+    stack = getattr(_SPANS, "stack", None)
+    if stack:
+        # nested profiles are spans of the outer profile
+        node = stack[-1][0].child(name)
+    else:
+        node = Span(name)
+        _SPANS.stack = []
+    _start_span(node)
+    try:
+        yield node
+    finally:
+        _end_span()
+        if report:
+            print(node.report())
@@ -1,10 +1,24 @@
+import sys
+import copy
+import math
+import json
+import weakref
 import warnings
 import logging
 import functools
+import threading
+from collections import OrderedDict
 from time import time
+from timeit import default_timer
 from pdb import set_trace
 from contextlib import contextmanager
 
+import numpy as np
+import scipy.sparse
+
+from boomlet import settings
+from boomlet.utils.array import array_hash
+
 
 def to_decorator(wrapped_func):
     """
@@ -118,6 +132,293 @@ def timer(func):
     return wrapped
 
 
+class MetricsRegistry(object):
+
+    """ call counts, total, min and max times, and histograms of times of instrumented functions
+
+    the histogram of a function maps e to the number of calls that took between 2 ** (e - 1) and 2 ** e seconds
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def record(self, name, seconds):
+        # exponent of the power of 2 bounding the time from above
+        bucket = math.frexp(max(seconds, 1e-9))[1]
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                self.metrics[name] = [1, seconds, seconds, seconds, {bucket: 1}]
+            else:
+                metric[0] += 1
+                metric[1] += seconds
+                metric[2] = min(metric[2], seconds)
+                metric[3] = max(metric[3], seconds)
+                metric[4][bucket] = metric[4].get(bucket, 0) + 1
+
+    def merge(self, snapshot):
+        """ adds the calls of a snapshot, e.g. from another process
+        """
+        with self.lock:
+            for name, other in snapshot.items():
+                histogram = dict((int(bucket), count)
+                                 for bucket, count in other["histogram"].items())
+                metric = self.metrics.get(name)
+                if metric is None:
+                    self.metrics[name] = [other["count"], other["total"],
+                                          other["min"], other["max"], histogram]
+                    continue
+                metric[0] += other["count"]
+                metric[1] += other["total"]
+                metric[2] = min(metric[2], other["min"])
+                metric[3] = max(metric[3], other["max"])
+                for bucket, count in histogram.items():
+                    metric[4][bucket] = metric[4].get(bucket, 0) + count
+
+    def snapshot(self, reset=False):
+        """ returns the metrics as a dict from function name to dict of statistics, optionally clearing them
+        """
+        with self.lock:
+            metrics = self.metrics
+            if reset:
+                self.metrics = {}
+            return dict((name, dict(count=count,
+                                    total=total,
+                                    mean=total / count,
+                                    min=min_seconds,
+                                    max=max_seconds,
+                                    histogram=dict(histogram)))
+                        for name, (count, total, min_seconds, max_seconds, histogram)
+                        in metrics.items())
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.snapshot(), **kwargs)
+
+    def reset(self):
+        with self.lock:
+            self.metrics = {}
+
+# registry of the functions decorated with instrument; calls in workers of
+# parallel maps are added to the registry of the process running the map
+METRICS = MetricsRegistry()
+
+
+def _record(name, seconds):
+    # looked up as a global, so that functions serialized by value for
+    # workers record into the registry of the worker instead of a copy
+    METRICS.record(name, seconds)
+
+
+def instrument(func=None, name=None):
+    """
+    Records the number of calls and times of the decorated function in
+    METRICS while settings.INSTRUMENT.ENABLED is set; otherwise, only a
+    setting is checked per call.
+
+    Example:
+
+    @instrument
+    def foo():
+        pass
+
+    @instrument(name="bar")
+    def bar():
+        pass
+    """
+    if func is None:
+        return functools.partial(instrument, name=name)
+    if name is None:
+        name = "{}.{}".format(func.__module__, func.__name__)
+
+    @functools.wraps(func)
+    def wrapped(*args, **kwargs):
+        if not settings.INSTRUMENT.ENABLED:
+            return func(*args, **kwargs)
+        start_time = default_timer()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _record(name, default_timer() - start_time)
+    return wrapped
+
+
+# number of elements sampled to check that an array hashed by identity is
+# unchanged
+_IDENTITY_SAMPLE_SIZE = 1000
+
+
+def _memo_key(obj, hash_arrays, refs):
+    """ hashable key of an argument, with arrays replaced by their hash and, when hashed by identity, weak references to them appended to refs
+    """
+    if isinstance(obj, np.ndarray):
+        if hash_arrays == "content":
+            return ("ndarray", array_hash(obj))
+        refs.append(weakref.ref(obj))
+        return ("ndarray", id(obj), array_hash(obj, _IDENTITY_SAMPLE_SIZE))
+    elif isinstance(obj, (list, tuple)):
+        return (type(obj).__name__,) + tuple(_memo_key(x, hash_arrays, refs) for x in obj)
+    elif isinstance(obj, dict):
+        return ("dict",) + tuple(sorted((k, _memo_key(v, hash_arrays, refs))
+                                        for k, v in obj.items()))
+    return obj
+
+
+# arrays of sparse matrices, by format
+_SPARSE_ARRAYS = ("data", "indices", "indptr", "row", "col", "offsets")
+
+
+def _arrays(obj):
+    """ arrays within an argument, including those of sparse matrices
+    """
+    if isinstance(obj, np.ndarray):
+        yield obj
+    elif scipy.sparse.issparse(obj):
+        for name in _SPARSE_ARRAYS:
+            if isinstance(getattr(obj, name, None), np.ndarray):
+                yield getattr(obj, name)
+    elif isinstance(obj, (list, tuple)):
+        for x in obj:
+            for arr in _arrays(x):
+                yield arr
+    elif isinstance(obj, dict):
+        for x in obj.values():
+            for arr in _arrays(x):
+                yield arr
+
+
+def _freeze_result(obj, arg_arrays):
+    """ returns a result to cache and its bytes, with its arrays made read-only since they are shared by all calls returning it; arrays sharing memory with the arguments, which belong to the caller, are copied first
+    """
+    if isinstance(obj, np.ndarray):
+        if any(np.may_share_memory(obj, arr) for arr in arg_arrays):
+            obj = obj.copy()
+        obj.flags.writeable = False
+        return obj, obj.nbytes
+    elif scipy.sparse.issparse(obj):
+        arrays = list(_arrays(obj))
+        if any(np.may_share_memory(x, arr) for x in arrays for arr in arg_arrays):
+            obj = obj.copy()
+            arrays = list(_arrays(obj))
+        # sparse matrices stay writable, since scipy sorts their indices
+        # in place
+        return obj, sys.getsizeof(obj) + sum(arr.nbytes for arr in arrays)
+    elif isinstance(obj, (list, tuple)):
+        frozen = [_freeze_result(x, arg_arrays) for x in obj]
+        nbytes = sys.getsizeof(obj) + sum(x_nbytes for _, x_nbytes in frozen)
+        if all(x is new_x for x, (new_x, _) in zip(obj, frozen)):
+            return obj, nbytes
+        values = [new_x for new_x, _ in frozen]
+        if isinstance(obj, list):
+            return values, nbytes
+        elif hasattr(obj, "_fields"):
+            return type(obj)(*values), nbytes
+        return tuple(values), nbytes
+    return obj, sys.getsizeof(obj)
+
+
+def _copy_result(obj):
+    """ copy of the lists, dicts and sets of a cached result, which are returned to each call, so that callers modifying them don't change the cache
+    """
+    if isinstance(obj, list):
+        return [_copy_result(x) for x in obj]
+    elif isinstance(obj, dict):
+        new_obj = copy.copy(obj)
+        for k, v in obj.items():
+            new_obj[k] = _copy_result(v)
+        return new_obj
+    elif isinstance(obj, (set, tuple)):
+        values = [_copy_result(x) for x in obj]
+        if isinstance(obj, set):
+            return type(obj)(values)
+        elif all(x is new_x for x, new_x in zip(obj, values)):
+            return obj
+        elif hasattr(obj, "_fields"):
+            return type(obj)(*values)
+        return tuple(values)
+    return obj
+
+
+def memoize(max_bytes=1e8, hash_arrays="content"):
+    """
+    Caches the results of the decorated function by its arguments, evicting
+    the least recently used results when the results take more than
+    max_bytes.
+
+    Array arguments are hashed by content with hash_arrays="content", or
+    with hash_arrays="identity" by identity along with a sample of their
+    elements to check that they were not changed, which is much faster for
+    large arrays but misses changes to the other elements. Arrays in
+    results are made read-only, since they are shared by all calls
+    returning them, after being copied if they share memory with the
+    arguments, and each call gets its own copy of the lists, dicts and sets
+    of results.
+
+    The decorated function has cache_info() returning hits, misses and
+    sizes, and cache_clear().
+
+    Example:
+
+    @memoize(max_bytes=1e9)
+    def foo(X):
+        return X.dot(X.T)
+    """
+    assert hash_arrays in ("content", "identity")
+
+    def decorator(func):
+        cache = OrderedDict()
+        lock = threading.Lock()
+        stats = dict(hits=0, misses=0, nbytes=0)
+
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            refs = []
+            try:
+                key = _memo_key((args, kwargs), hash_arrays, refs)
+                hash(key)
+            except TypeError:
+                # unhashable arguments aren't cached
+                return func(*args, **kwargs)
+            with lock:
+                entry = cache.pop(key, None)
+                # arrays hashed by identity must be the same objects, since
+                # ids are reused after arrays are freed
+                if entry is not None and all(ref() is not None and ref() is entry_ref()
+                                             for ref, entry_ref in zip(refs, entry[2])):
+                    cache[key] = entry
+                    stats["hits"] += 1
+                    return _copy_result(entry[0])
+                if entry is not None:
+                    stats["nbytes"] -= entry[1]
+                stats["misses"] += 1
+            result = func(*args, **kwargs)
+            result, nbytes = _freeze_result(result, list(_arrays((args, kwargs))))
+            if nbytes <= max_bytes:
+                with lock:
+                    if key in cache:
+                        stats["nbytes"] -= cache.pop(key)[1]
+                    cache[key] = (result, nbytes, refs)
+                    stats["nbytes"] += nbytes
+                    while stats["nbytes"] > max_bytes:
+                        _, (_, evicted_nbytes, _) = cache.popitem(last=False)
+                        stats["nbytes"] -= evicted_nbytes
+            return _copy_result(result)
+
+        def cache_info():
+            with lock:
+                return dict(stats, entries=len(cache), max_bytes=max_bytes)
+
+        def cache_clear():
+            with lock:
+                cache.clear()
+                stats.update(hits=0, misses=0, nbytes=0)
+
+        wrapped.cache_info = cache_info
+        wrapped.cache_clear = cache_clear
+        return wrapped
+    return decorator
+
+
 def trace_error(func):
     """ python debugger is started if functions throws an exception
     """
@@ -1,28 +1,281 @@
 import os
+import json
+import uuid
+import errno
+import socket
+import hashlib
+import threading
+from time import time
 
-from boomlet.parallel import pmap
-from boomlet.storage import joblib_dump
+from boomlet.parallel import pimap_unordered
+from boomlet.storage import (joblib_dump, file_lock, atomic_write, writes,
+                             reads, exists, mkdir)
 
+# manifest of the inputs that folder_apply processed, in the applied folder
+MANIFEST = ".folder_apply.json"
+MANIFEST_LOCK = ".folder_apply.lock"
+# folder of the lock files of inputs claimed by sharded folder_apply calls
+CLAIMS_FOLDER = ".folder_apply.claims"
+# seconds between saves of the manifest while a folder is processed
+MANIFEST_SAVE_SECONDS = 10
 
-def _folder_autorun_helper(filename, func):
+
+def _is_input(name, ext):
+    """ whether a file of a folder is an input of folder_apply, rather than one of its own files or a temporary file of atomic_write
+    """
+    if name in (MANIFEST, MANIFEST_LOCK, CLAIMS_FOLDER):
+        return False
+    if name.startswith(".") and name.endswith(".tmp"):
+        return False
+    return name.endswith(ext)
+
+
+def file_hash(filename, block_size=1 << 20):
+    h = hashlib.md5()
+    with open(filename, 'rb') as infile:
+        for block in iter(lambda: infile.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _manifest_mtime(folder):
+    filename = os.path.join(folder, MANIFEST)
+    return os.path.getmtime(filename) if exists(filename) else None
+
+
+def _read_manifest(folder):
+    filename = os.path.join(folder, MANIFEST)
+    if not exists(filename):
+        return {}
+    return json.loads(reads(filename))
+
+
+def _update_manifest(folder, entries):
+    """ merges entries into the manifest of a folder, which other processes may update at the same time
+    """
+    if not entries:
+        return
+    with file_lock(os.path.join(folder, MANIFEST_LOCK)):
+        manifest = _read_manifest(folder)
+        manifest.update(entries)
+        with atomic_write(os.path.join(folder, MANIFEST)) as tmp_filename:
+            writes(tmp_filename, json.dumps(manifest))
+
+
+def _is_current(path, entry, check):
+    """ returns whether an input is unchanged since its manifest entry, and its current fingerprint
+    """
+    stat = os.stat(path)
+    fingerprint = dict(size=stat.st_size, mtime=stat.st_mtime)
+    same_size = entry is not None and entry["size"] == fingerprint["size"]
+    if same_size and entry["mtime"] == fingerprint["mtime"]:
+        if "md5" in entry:
+            fingerprint["md5"] = entry["md5"]
+        return True, fingerprint
+    if check == "hash":
+        # only inputs whose modification time changed are hashed
+        fingerprint["md5"] = file_hash(path)
+        return same_size and entry.get("md5") == fingerprint["md5"], fingerprint
+    return False, fingerprint
+
+
+class _Claims(object):
+
+    """ claims on the inputs of a folder, shared with folder_apply calls in other processes or on other hosts with the same filesystem, through lock files created atomically
+
+    claims are refreshed by a background thread, and claims that were not refreshed for lease seconds are presumed to belong to crashed processes and are taken over
+    """
+
+    def __init__(self, folder, lease):
+        self.folder = os.path.join(folder, CLAIMS_FOLDER)
+        self.lease = lease
+        self.token = "{}.{}.{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        self.active = set()
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        mkdir(os.path.join(self.folder, ""))
+        self.thread = threading.Thread(target=self._heartbeat)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _path(self, name):
+        return os.path.join(self.folder, name + ".lock")
+
+    def claim(self, name):
+        """ returns whether the input was claimed
+        """
+        path = self._path(name)
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                if not self._remove_stale(path):
+                    return False
+                continue
+            with os.fdopen(fd, 'w') as outfile:
+                outfile.write(self.token)
+            with self.lock:
+                self.active.add(name)
+            return True
+        return False
+
+    def _remove_stale(self, path):
+        """ removes a claim that was not refreshed within the lease, returning whether it was removed
+        """
+        stale_path = "{}.{}.stale".format(path, self.token)
+        try:
+            if time() - os.path.getmtime(path) <= self.lease:
+                return False
+            # only one process can move the claim away
+            os.rename(path, stale_path)
+        except OSError:
+            return False
+        if time() - os.path.getmtime(stale_path) <= self.lease:
+            # the claim was refreshed or taken over between the check and
+            # the rename, so it is put back unless claimed again since
+            try:
+                os.link(stale_path, path)
+            except OSError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        return True
+
+    def _heartbeat(self):
+        while not self.stop.wait(self.lease / 3.0):
+            with self.lock:
+                names = list(self.active)
+            for name in names:
+                try:
+                    os.utime(self._path(name), None)
+                except OSError:
+                    pass
+
+    def release(self, names):
+        for name in names:
+            with self.lock:
+                self.active.discard(name)
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+
+    def close(self):
+        self.stop.set()
+        self.release(list(self.active))
+
+
+def _folder_apply_helper(func, filename):
     result = func(filename)
-    joblib_dump(filename + ".pkl", result)
+    joblib_dump(filename + ".pkl", result, atomic=True)
+    return filename
+
+
+def _claimed_paths(claims, paths, manifest, manifest_mtime, fingerprints, check):
+    """ lazily claims inputs, yielding the ones that were claimed and are still not applied on
+    """
+    folder = os.path.dirname(claims.folder)
+    for path in paths:
+        name = os.path.basename(path)
+        if not claims.claim(name):
+            continue
+        # another call may have applied on the input since the manifest
+        # was read
+        if _manifest_mtime(folder) != manifest_mtime:
+            manifest_mtime = _manifest_mtime(folder)
+            manifest = _read_manifest(folder)
+        current, fingerprints[name] = _is_current(path, manifest.get(name), check)
+        if current and exists(path + ".pkl"):
+            claims.release([name])
+            continue
+        yield path
 
 
-def folder_apply(func, folder, ext, parallel=False):
+def folder_apply(func, folder, ext, parallel=False, check="mtime",
+                 shard=False, lease=600):
     """
     Applies a function on the filenames of all files in a folder
     with a given extension (not ".pkl" or ".npy"), and serializes
     the output.
+
+    Only files that are new or changed since they were last processed are
+    applied on, according to a manifest in the folder: a file changed if its
+    size or modification time changed, or with check="hash" if its size or
+    md5 hash changed. Files without a manifest entry are only applied on if
+    they have no output or are newer than their output, so that folders
+    processed before there was a manifest aren't processed again. Outputs
+    are written atomically as soon as they are ready, so an interrupted run
+    can be resumed.
+
+    With shard=True, several calls on the same folder, from different
+    processes or hosts with a shared filesystem, split its files: each file
+    is claimed through a lock file, and claims that were not refreshed for
+    lease seconds (because their process crashed) are taken over.
+
+    Returns the files that were applied on by this call.
     """
     assert ext.startswith(".")
     assert ext not in (".pkl", ".npy")
+    assert check in ("mtime", "hash")
     all_files = set(os.listdir(folder))
-    ext_files = filter(lambda x: x.endswith(ext), all_files)
-    new_files = filter(lambda x: (x + ".pkl") not in all_files, ext_files)
+    manifest_mtime = _manifest_mtime(folder)
+    manifest = _read_manifest(folder)
+    fingerprints = {}
+    unchanged = {}
+    new_files = []
+    for name in sorted(all_files):
+        if not _is_input(name, ext):
+            continue
+        current, fingerprint = _is_current(os.path.join(folder, name),
+                                           manifest.get(name),
+                                           check)
+        has_output = (name + ".pkl") in all_files
+        if (has_output and name not in manifest and
+                os.path.getmtime(os.path.join(folder, name + ".pkl")) >=
+                fingerprint["mtime"]):
+            # output written before there was a manifest entry for the file
+            # (e.g. by a version without manifests)
+            current = True
+        if current and has_output:
+            if fingerprint != manifest.get(name):
+                # e.g. touched but with the same hash, or without an entry
+                unchanged[name] = fingerprint
+        else:
+            new_files.append(name)
+            fingerprints[name] = fingerprint
+    _update_manifest(folder, unchanged)
+
     new_file_paths = [os.path.join(folder, x) for x in new_files]
+    claims = None
+    if shard:
+        claims = _Claims(folder, lease)
+        new_file_paths = _claimed_paths(claims, new_file_paths, manifest,
+                                        manifest_mtime, fingerprints, check)
     if parallel:
-        pmap(_folder_autorun_helper, new_file_paths, func)
+        finished = pimap_unordered(_folder_apply_helper, new_file_paths, func)
     else:
-        map(lambda x: _folder_autorun_helper(x, func), new_file_paths)
-    return new_files
+        finished = (_folder_apply_helper(func, x) for x in new_file_paths)
+    applied = []
+    entries = {}
+    last_save = time()
+    try:
+        for path in finished:
+            name = os.path.basename(path)
+            applied.append(name)
+            entries[name] = fingerprints[name]
+            if time() - last_save > MANIFEST_SAVE_SECONDS:
+                _update_manifest(folder, entries)
+                if claims is not None:
+                    # claims are kept until the manifest is saved, so that
+                    # other calls don't apply on the same files again
+                    claims.release(entries)
+                entries = {}
+                last_save = time()
+    finally:
+        _update_manifest(folder, entries)
+        if claims is not None:
+            claims.close()
+    return sorted(applied)
@@ -1,10 +1,10 @@
 import random
 import numpy as np
 
-from boomlet.utils.heap import ConstSizeHeap
+from boomlet.utils.heap import TopK
 from boomlet.utils.collection import grouper
 from boomlet.utils.estimators import quick_score
-from boomlet.parallel import pmap
+from boomlet.parallel import seeded_pmap
 
 
 def bits_to_char(bits):
@@ -34,34 +34,34 @@ def bitmask_from_string(string):
     return [bit for bit8 in bits for bit in bit8]
 
 
-def bitmask_child(bitmask1, bitmask2):
+def bitmask_child(bitmask1, bitmask2, rng=random):
     assert len(bitmask1) == len(bitmask2)
-    return [bit1 if random.random() > 0.5 else bit2 for bit1, bit2 in zip(bitmask1, bitmask2)]
+    return [bit1 if rng.random() > 0.5 else bit2 for bit1, bit2 in zip(bitmask1, bitmask2)]
 
 
-def bitmask_mutant(bitmask, avg_mutations=100):
+def bitmask_mutant(bitmask, avg_mutations=100, rng=random):
     mutation_rate = float(avg_mutations) / len(bitmask)
-    return [bit if random.random() > mutation_rate else 1 - bit for bit in bitmask]
+    return [bit if rng.random() > mutation_rate else 1 - bit for bit in bitmask]
 
 
-def bitmask_evolve(bitmasks, avg_mutations=100, child_rate=0.5):
-    if random.random() <= child_rate:
-        return bitmask_child(*random.sample(bitmasks, 2))
+def bitmask_evolve(bitmasks, avg_mutations=100, child_rate=0.5, rng=random):
+    if rng.random() <= child_rate:
+        return bitmask_child(*rng.sample(bitmasks, 2), rng=rng)
     else:
-        return bitmask_mutant(*random.sample(bitmasks, 1), avg_mutations=avg_mutations)
+        return bitmask_mutant(*rng.sample(bitmasks, 1), avg_mutations=avg_mutations, rng=rng)
 
 
-def random_bitmask(bits):
-    return [random.randint(0, 1) for _ in range(bits)]
+def random_bitmask(bits, rng=random):
+    return [rng.randint(0, 1) for _ in range(bits)]
 
 
-def bitmask_generation(bitmasks, history, bits, size=32, avg_mutations=100, child_rate=0.5):
+def bitmask_generation(bitmasks, history, bits, size=32, avg_mutations=100, child_rate=0.5, rng=random):
     generation = []
     while len(generation) < size:
         if bitmasks:
-            new_bitmask = bitmask_evolve(bitmasks, avg_mutations, child_rate)
+            new_bitmask = bitmask_evolve(bitmasks, avg_mutations, child_rate, rng)
         else:
-            new_bitmask = random_bitmask(bits)
+            new_bitmask = random_bitmask(bits, rng)
         bitmask_str = bitmask_to_string(new_bitmask)
         if bitmask_str not in history:
             generation.append(new_bitmask)
@@ -71,19 +71,20 @@ def bitmask_generation(bitmasks, history, bits, size=32, avg_mutations=100, chil
 
 def bitmask_genetic_algorithm(bits, score_func, history=None, gene_pool=None, epochs=100, population_size=32, avg_mutations=100, child_rate=0.5, verbose=False, random_state=None):
     """ genetic algorithm that MAXIMIZES the value of the input scoring function
+
+    with a random_state, the scoring function runs with random and numpy.random seeded per bitmask, so results don't depend on the number of jobs
     """
-    if random_state is not None:
-        random.seed(random_state)
+    rng = random if random_state is None else random.Random(random_state)
     if history is None:
         history = set()
     if gene_pool is None:
-        gene_pool = ConstSizeHeap(population_size)
+        gene_pool = TopK(population_size)
     for i in range(epochs):
         bitmasks = [parent[1] for parent in gene_pool.to_list()]
-        generation = bitmask_generation(bitmasks, history, bits, population_size, avg_mutations, child_rate)
-        scores = pmap(score_func, generation)
-        for item in zip(scores, generation):
-            gene_pool.push(item)
+        generation = bitmask_generation(bitmasks, history, bits, population_size, avg_mutations, child_rate, rng)
+        epoch_seed = None if random_state is None else (random_state, i)
+        scores = seeded_pmap(score_func, generation, epoch_seed)
+        gene_pool.push_many(scores, generation)
         if verbose:
             print "Completed epoch: {}\t Best score: {}".format(i, max([x[0] for x in gene_pool.to_list()]))
     return gene_pool
@@ -113,7 +114,7 @@ def bitmask_score_func(clf,
         else:
             new_X_valid = None
         return quick_score(clf=clf,
-                           X=X,
+                           X=new_X,
                            y=y,
                            score_func=score_func,
                            X_valid=new_X_valid,
@@ -1,8 +1,15 @@
 from copy import deepcopy
 import numpy as np
+import scipy.sparse
 from sklearn.base import BaseEstimator
 
-from boomlet.utils.collection import group_by
+from boomlet.utils.collection import GroupBy
+
+
+def _key_column(X, j):
+    if scipy.sparse.issparse(X):
+        return np.asarray(X[:, j].todense()).ravel()
+    return X[:, j]
 
 
 class BinningEstimator(BaseEstimator):
@@ -13,10 +20,8 @@ class BinningEstimator(BaseEstimator):
         self.meta_index = meta_index
 
     def fit(self, X, y=None):
-        grouped = group_by(range(X.shape[0]), lambda i: X[i, self.meta_index])
-
         self.clfs_ = {}
-        for k, indices in grouped.items():
+        for k, indices in GroupBy(_key_column(X, self.meta_index)):
             tmp_clf = deepcopy(self.clf)
             if y is None:
                 tmp_clf.fit(X[indices])
@@ -26,10 +31,8 @@ class BinningEstimator(BaseEstimator):
         return self
 
     def binning_apply(self, name, X, *args, **kwargs):
-        grouped = group_by(range(X.shape[0]), lambda i: X[i, self.meta_index])
-
         output = None
-        for k, indices in grouped.items():
+        for k, indices in GroupBy(_key_column(X, self.meta_index)):
             if k in self.clfs_:
                 values = getattr(self.clfs_[k], name)(X[indices], *args, **kwargs)
                 if output is None:
@@ -6,6 +6,48 @@ from sklearn.cross_validation import ShuffleSplit
 
 from boomlet.utils import aggregators
 from boomlet.utils.estimators import flexible_int
+from boomlet.contextmanagers import spawn_seeds
+from boomlet.parallel import pmap, pimap
+
+
+def _seeded_copy(clf, seed):
+    clf = deepcopy(clf)
+    if seed is not None and "random_state" in clf.get_params():
+        clf.set_params(random_state=seed)
+    return clf
+
+
+def _fit_rows(clf, X, y, seeded_indices):
+    seed, indices = seeded_indices
+    return _seeded_copy(clf, seed).fit(X[indices], y[indices])
+
+
+def _fit_cols(clf, X, y, seeded_indices):
+    seed, indices = seeded_indices
+    return _seeded_copy(clf, seed).fit(X[:, indices], y)
+
+
+def _predict_rows(method, X, clf):
+    return getattr(clf, method)(X)
+
+
+def _predict_cols(method, X, indexed_clf):
+    indices, clf = indexed_clf
+    return getattr(clf, method)(X[:, indices])
+
+
+def _aggregate(aggregator, predictions):
+    """ folds the predictions of the models into a running aggregator as they are made, if the aggregator has one, so that they don't have to be kept
+    """
+    predictions = iter(predictions)
+    first = next(predictions)
+    running = aggregators.to_running_aggregator(aggregator, np.asarray(first).dtype)
+    if running is None:
+        return aggregator([first] + list(predictions), axis=0)
+    running.update(first)
+    for prediction in predictions:
+        running.update(prediction)
+    return running.result()
 
 
 class RowSampler(BaseEstimator):
@@ -13,6 +55,8 @@ class RowSampler(BaseEstimator):
     """ Class that trains several models on a small sample of the data and returns a combination of their predictions.
 
     Make sure classifiers have the right set of classes, because due to sampling, not all classes may be represented in each training set.
+
+    Models are fit in parallel; with a random_state, each model gets a random_state spawned from it, so results don't depend on the number of jobs.
     """
 
     def __init__(self,
@@ -40,29 +84,25 @@ class RowSampler(BaseEstimator):
             random_state=self.random_state,
             test_size=flexible_int(X.shape[0], self.sample_size)
         )
-        self.clfs_ = []
-        for _, indices in ss:
-            tmp_clf = deepcopy(self.clf)
-            tmp_clf.fit(train[indices], y[indices])
-            self.clfs_.append(tmp_clf)
+        splits = [indices for _, indices in ss]
+        seeds = spawn_seeds(self.random_state, len(splits))
+        self.clfs_ = pmap(_fit_rows, zip(seeds, splits), self.clf, train, y)
         return self
 
     def predict(self, X):
-        data = []
-        for clf in self.clfs_:
-            data.append(clf.predict(X))
-        return self.aggregator(data, axis=0)
+        return _aggregate(self.aggregator,
+                          pimap(_predict_rows, self.clfs_, "predict", X))
 
     def predict_proba(self, X):
-        data = []
-        for clf in self.clfs_:
-            data.append(clf.predict_proba(X))
-        return self.aggregator(data, axis=0)
+        return _aggregate(self.aggregator,
+                          pimap(_predict_rows, self.clfs_, "predict_proba", X))
 
 
 class ColSampler(BaseEstimator):
 
     """ Class that trains several models on a small sample of the features and returns a combination of their predictions.
+
+    Models are fit in parallel; with a random_state, each model gets a random_state spawned from it, so results don't depend on the number of jobs.
     """
 
     def __init__(self,
@@ -91,21 +131,20 @@ class ColSampler(BaseEstimator):
             test_size=flexible_int(X.shape[1], self.sample_size)
         )
         self.indices_ = [indices for _, indices in ss]
-        self.clfs_ = []
-        for indices in self.indices:
-            tmp_clf = deepcopy(self.clf)
-            tmp_clf.fit(train[:, indices], y)
-            self.clfs_.append(tmp_clf)
+        seeds = spawn_seeds(self.random_state, len(self.indices_))
+        self.clfs_ = pmap(_fit_cols, zip(seeds, self.indices_), self.clf, train, y)
         return self
 
     def predict(self, X):
-        data = []
-        for indices, clf in zip(self.indices_, self.clfs_):
-            data.append(clf.predict(X[:, indices]))
-        return self.aggregator(data, axis=0)
+        return _aggregate(self.aggregator,
+                          pimap(_predict_cols,
+                                zip(self.indices_, self.clfs_),
+                                "predict",
+                                X))
 
     def predict_proba(self, X):
-        data = []
-        for indices, clf in zip(self.indices_, self.clfs_):
-            data.append(clf.predict_proba(X[:, indices]))
-        return self.aggregator(data, axis=0)
+        return _aggregate(self.aggregator,
+                          pimap(_predict_cols,
+                                zip(self.indices_, self.clfs_),
+                                "predict_proba",
+                                X))
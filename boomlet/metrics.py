@@ -1,18 +1,14 @@
-from collections import Counter
-
 import numpy as np
 
 
 def gini_coefficient(x):
     # half of relative mean difference
-    sorted_x = sorted(x)
-    len_x = len(x)
-    tot = 0.0
-    for i, xi in enumerate(sorted_x):
-        added = i
-        subtracted = len_x - i - 1
-        tot += (added - subtracted) * xi
-    return tot / (len_x ** 2)
+    sorted_x = np.sort(np.asarray(x, dtype=float))
+    len_x = len(sorted_x)
+    # the i-th smallest value is added for the i values before it and
+    # subtracted for the values after it
+    weights = 2 * np.arange(len_x) - (len_x - 1)
+    return np.dot(weights, sorted_x) / (len_x ** 2)
 
 
 def max_error(y_true, pred):
@@ -32,14 +28,137 @@ def gini_loss(y_true, pred):
 
 
 def categorical_gini_coefficient(x):
+    # sum over categories of the number of values not in the category
     len_x = len(x)
-    counter = Counter(x)
-    total = 0.0
-    for _, count in counter.items():
-        total += len_x - count
-    return total / (len_x ** 2)
+    n_categories = len(np.unique(x))
+    return (n_categories - 1.0) * len_x / (len_x ** 2)
 
 
 def categorical_gini_loss(y_true, y_pred):
     # this is kind of random
     return categorical_gini_coefficient(y_true != y_pred)
+
+
+def chunked_gini_coefficient(make_chunks, max_elements=1e7, bins=4096):
+    """
+    gini_coefficient of the values of the arrays yielded by make_chunks()
+    (which is called once per pass over the values), with at most about
+    max_elements values in memory besides the chunks
+
+    the result is exact: the range of the values is split with a histogram
+    into groups of consecutive values that fit in memory, and each group is
+    sorted in a pass of its own
+    """
+    len_x = 0
+    lo, hi = np.inf, -np.inf
+    for chunk in make_chunks():
+        if len(chunk):
+            len_x += len(chunk)
+            lo = min(lo, chunk.min())
+            hi = max(hi, chunk.max())
+    if len_x <= max_elements:
+        return gini_coefficient(np.concatenate(list(make_chunks())))
+    if lo == hi:
+        return 0.0
+    counts = np.zeros(bins, dtype=np.int64)
+    for chunk in make_chunks():
+        chunk_counts, edges = np.histogram(chunk, bins=bins, range=(lo, hi))
+        counts += chunk_counts
+    # each group is a range of bins with at most max_elements values, unless
+    # a single bin has more
+    groups = []
+    start, size = 0, 0
+    for i, count in enumerate(counts):
+        if size and size + count > max_elements:
+            groups.append((start, i))
+            start, size = i, 0
+        size += count
+    groups.append((start, bins))
+    total = 0.0
+    below = 0
+    for first, stop in groups:
+        group_lo, group_hi = edges[first], edges[stop]
+        last = stop == bins
+        values = np.sort(np.concatenate([
+            chunk[(chunk >= group_lo) & ((chunk <= group_hi) if last else (chunk < group_hi))]
+            for chunk in make_chunks()]).astype(float))
+        ranks = below + np.arange(len(values))
+        total += np.dot(2 * ranks - (len_x - 1), values)
+        below += len(values)
+    return total / (len_x ** 2)
+
+
+class MetricAccumulator(object):
+
+    """
+    accumulates the metrics of this module over chunks of y_true and pred,
+    except gini_loss which needs all the errors at once (see chunked_metrics)
+
+    variances are merged from the mean and sum of squared deviations of each
+    chunk, so they are as accurate as with np.std
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.max_error = -np.inf
+        # count, mean and sum of squared deviations
+        self.errors = (0, 0.0, 0.0)
+        self.y_true = (0, 0.0, 0.0)
+        self.mismatches = set()
+
+    @staticmethod
+    def _merge(moments, x):
+        count_a, mean_a, m2_a = moments
+        count_b = len(x)
+        mean_b = np.mean(x)
+        m2_b = np.sum((x - mean_b) ** 2)
+        count = count_a + count_b
+        delta = mean_b - mean_a
+        return (count,
+                mean_a + delta * count_b / float(count),
+                m2_a + m2_b + delta ** 2 * count_a * count_b / float(count))
+
+    def update(self, y_true, pred):
+        y_true = np.asarray(y_true)
+        pred = np.asarray(pred)
+        if not len(y_true):
+            return self
+        errors = y_true - pred
+        self.count += len(y_true)
+        self.max_error = max(self.max_error, np.max(np.abs(errors)))
+        self.errors = self._merge(self.errors, errors)
+        self.y_true = self._merge(self.y_true, y_true)
+        self.mismatches.update(np.unique(y_true != pred).tolist())
+        return self
+
+    def result(self):
+        error_var = self.errors[2] / self.count
+        return dict(
+            max_error=self.max_error,
+            error_variance=error_var,
+            relative_error_variance=error_var / (self.y_true[2] / self.count),
+            categorical_gini_loss=(len(self.mismatches) - 1.0) / self.count,
+        )
+
+
+def chunked_metrics(y_true, pred, chunk_size=int(1e6), max_elements=1e7):
+    """
+    evaluates all the metrics of this module on y_true and pred (e.g.
+    memmaps) chunk_size rows at a time, so that they are never fully loaded
+
+    returns a dict from metric name to value
+    """
+    assert len(y_true) == len(pred)
+    slices = [slice(start, start + chunk_size)
+              for start in range(0, len(y_true), chunk_size)]
+
+    def error_chunks():
+        for s in slices:
+            yield np.asarray(y_true[s]) - np.asarray(pred[s])
+
+    accumulator = MetricAccumulator()
+    for s in slices:
+        accumulator.update(y_true[s], pred[s])
+    results = accumulator.result()
+    results["gini_loss"] = chunked_gini_coefficient(error_chunks, max_elements)
+    return results
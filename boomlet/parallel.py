@@ -1,78 +1,822 @@
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import os
+import sys
+import atexit
+import shutil
+import tempfile
+import itertools
+import threading
 import multiprocessing
+import multiprocessing.pool
 
 from pickle import PicklingError
+from time import time
 from functools import partial
+from contextlib import contextmanager
 from joblib import Parallel, delayed
 
-from boomlet.settings import PARALLEL
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
 
+from boomlet.settings import PARALLEL, PARALLEL_CONTEXT, INSTRUMENT
+from boomlet.decorators import METRICS
+from boomlet.storage import ArrayFolder
+from boomlet.contextmanagers import seed_random, spawn_seeds
+from boomlet.utils import memory
 
-def joblib_parmap(func, generator):
+
+def n_jobs():
+    """ number of workers to use for parallel maps
+    """
+    return multiprocessing.cpu_count() if PARALLEL.JOBS == -1 else PARALLEL.JOBS
+
+
+def available_cores():
+    """ number of cores that a parallel map started in the current task may use
+    """
+    if multiprocessing.current_process().daemon:
+        # daemonic processes can't start workers of their own
+        return 1
+    elif PARALLEL_CONTEXT.CORES is None:
+        return n_jobs()
+    else:
+        return PARALLEL_CONTEXT.CORES
+
+
+@contextmanager
+def cores(n):
+    """ limits parallel maps within the context to a number of cores
+    """
+    old_cores = PARALLEL_CONTEXT.CORES
+    PARALLEL_CONTEXT.CORES = n
+    try:
+        yield
+    finally:
+        PARALLEL_CONTEXT.CORES = old_cores
+
+
+class WithCores(object):
+
+    """ picklable wrapper that runs a function with a core budget and a backend for the parallel maps within it, since workers don't inherit the context of the map
+    """
+
+    def __init__(self, func, n_cores, backend=None):
+        self.func = func
+        self.n_cores = n_cores
+        self.backend = backend
+
+    def __call__(self, item):
+        with cores(self.n_cores), use_backend(self.backend):
+            return self.func(item)
+
+
+def current_backend():
+    """ backend used by parallel maps in the current thread
+    """
+    if PARALLEL_CONTEXT.BACKEND is None:
+        return PARALLEL.BACKEND
+    else:
+        return PARALLEL_CONTEXT.BACKEND
+
+
+@contextmanager
+def use_backend(backend):
+    """ runs parallel maps within the context with a backend ("process", "thread" or "cluster")
+    """
+    old_backend = PARALLEL_CONTEXT.BACKEND
+    PARALLEL_CONTEXT.BACKEND = backend
+    try:
+        yield
+    finally:
+        PARALLEL_CONTEXT.BACKEND = old_backend
+
+
+@contextmanager
+def blas_threads(n):
+    """ limits the threads used by BLAS within the context, if threadpoolctl is installed
+    """
+    if n is None or threadpool_limits is None:
+        yield
+    else:
+        with threadpool_limits(limits=n, user_api="blas"):
+            yield
+
+
+_TOKENS = itertools.count()
+_SHARED_FOLDERS = set()
+# only the function of the most recent map is kept in a worker, so that
+# memory-mapped arrays of finished maps are released soon
+_WORKER_FUNC = {}
+# seconds between checks that the workers of a map are still alive while no
+# result arrives
+_POLL_SECONDS = 0.5
+
+
+class _Pools(object):
+
+    """ persistent worker pools of a process by backend, with the number of maps using each pool, so that a pool replaced by a larger one is only terminated once the maps using it finished
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        # backend -> (pool, number of workers)
+        self.pools = {}
+        # pool -> number of maps using it
+        self.users = {}
+        self.retired = set()
+
+    def __reduce__(self):
+        # pools can't be pickled, and dill pickles this module by value
+        # along with functions using it when it is not installed
+        return (_Pools, ())
+
+
+_POOLS = _Pools()
+# whether this process is a worker of a process pool, whose nested maps get
+# pools of their own for the duration of the map, instead of keeping
+# persistent pools alive in every worker
+_POOL_WORKER = False
+
+
+class _NonDaemonProcess(multiprocessing.Process):
+    # pool workers are daemonic by default, which would prevent them from
+    # starting workers for the parallel maps nested within them
+
+    def _get_daemon(self):
+        return False
+
+    def _set_daemon(self, value):
+        pass
+
+    daemon = property(_get_daemon, _set_daemon)
+
+
+class _NonDaemonPool(multiprocessing.pool.Pool):
+    if sys.version_info[0] < 3:
+        Process = _NonDaemonProcess
+    else:
+        # python 3 pools create their workers with Process(ctx, ...), where
+        # ctx is the default context, which multiprocessing.Process uses
+        @staticmethod
+        def Process(ctx, *args, **kwds):
+            return _NonDaemonProcess(*args, **kwds)
+
+
+def _init_worker():
+    global _POOLS, _POOL_WORKER
+    # the pools of the parent are not usable, and their lock was inherited
+    # while it was held by the parent starting this worker
+    _POOLS = _Pools()
+    _POOL_WORKER = True
+    # calls recorded by the parent before the fork are not this worker's
+    METRICS.lock = threading.Lock()
+    METRICS.reset()
+    cluster = sys.modules.get("boomlet.cluster")
+    if cluster is not None:
+        # the coordinator of the parent isn't served by this process
+        cluster._reset()
+
+
+def _start_pool(backend, size):
+    if backend == "process":
+        return _NonDaemonPool(size, _init_worker)
+    elif backend == "thread":
+        return multiprocessing.pool.ThreadPool(size)
+    else:
+        raise Exception("Improper parallel backend: {}".format(backend))
+
+
+def _current_pools():
+    global _POOLS
+    if _POOLS.pid != os.getpid():
+        # pools inherited through fork belong to the parent process
+        _POOLS = _Pools()
+    return _POOLS
+
+
+@contextmanager
+def using_pool(size=None, backend="process"):
+    """ yields the persistent worker pool of a backend ("process" or "thread"), starting it on first use, or starting a larger one if it has less than size workers (default: n_jobs())
+
+    pools are shared by all the maps of a process, which limit how many of their tasks run at once instead of using pools of their own size, and a replaced pool is only terminated once no map uses it
+    """
+    if size is None:
+        size = n_jobs()
+    pools = _current_pools()
+    with pools.lock:
+        pool, pool_size = pools.pools.get(backend, (None, 0))
+        if pool is None or pool_size < size:
+            if pool in pools.users:
+                pools.retired.add(pool)
+            elif pool is not None:
+                _terminate(pool)
+            pool = _start_pool(backend, size)
+            pools.pools[backend] = (pool, size)
+        pools.users[pool] = pools.users.get(pool, 0) + 1
+    try:
+        yield pool
+    finally:
+        with pools.lock:
+            # the pool may have been shut down while it was used
+            users = pools.users.pop(pool, 1) - 1
+            if users:
+                pools.users[pool] = users
+            retired = not users and pool in pools.retired
+            if retired:
+                pools.retired.discard(pool)
+        if retired:
+            _terminate(pool)
+
+
+def get_pool(size=None, backend="process"):
+    """ returns the persistent worker pool of a backend (see using_pool), which may be replaced by a larger pool when a map asks for more workers
+    """
+    with using_pool(size, backend) as pool:
+        return pool
+
+
+def shutdown_pool():
+    """ terminates the persistent worker pools of this process
+    """
+    pools = _current_pools()
+    with pools.lock:
+        running = [pool for pool, _ in pools.pools.values()] + list(pools.retired)
+        pools.pools.clear()
+        pools.users.clear()
+        pools.retired.clear()
+    for pool in running:
+        _terminate(pool)
+
+
+def _terminate(pool):
+    pool.terminate()
+    pool.join()
+
+
+atexit.register(shutdown_pool)
+
+
+def _free_bytes(folder):
+    stat = os.statvfs(folder)
+    return stat.f_bavail * stat.f_frsize
+
+
+def temp_folder(nbytes=0):
+    """ folder that arrays shared with workers are written to: PARALLEL.TEMP_FOLDER if set, else /dev/shm if nbytes more still leave PARALLEL.SHM_MIN_FREE bytes free in it, else the system temporary folder
+    """
+    if PARALLEL.TEMP_FOLDER is not None:
+        return PARALLEL.TEMP_FOLDER
+    elif (os.path.isdir("/dev/shm")
+          and _free_bytes("/dev/shm") - nbytes >= PARALLEL.SHM_MIN_FREE):
+        return "/dev/shm"
+    else:
+        return tempfile.gettempdir()
+
+
+class _SharedArrays(ArrayFolder):
+
+    """ ArrayFolder that saves each array to a folder with the same name in the temp_folder with room for it
+    """
+
+    def __init__(self, name, min_nbytes):
+        ArrayFolder.__init__(self, os.path.join(temp_folder(), name), min_nbytes)
+        self.name = name
+        self.folders = set([self.folder])
+
+    def array_folder(self, obj):
+        folder = os.path.join(temp_folder(obj.nbytes), self.name)
+        self.folders.add(folder)
+        _SHARED_FOLDERS.add(folder)
+        return folder
+
+
+@contextmanager
+def shared_arrays():
+    """ yields an ArrayFolder that large arrays are published to once for the duration of a parallel map, so that workers memory-map them instead of unpickling copies; the files are deleted afterwards
+    """
+    min_nbytes = PARALLEL.SHARED_ARRAY_NBYTES
+    if min_nbytes is None:
+        min_nbytes = float("inf")
+    arrays = _SharedArrays("boomlet-{}-{}".format(os.getpid(), next(_TOKENS)), min_nbytes)
+    _SHARED_FOLDERS.add(arrays.folder)
+    try:
+        yield arrays
+    finally:
+        for folder in arrays.folders:
+            shutil.rmtree(folder, ignore_errors=True)
+            _SHARED_FOLDERS.discard(folder)
+
+
+def _remove_shared_folders():
+    for folder in list(_SHARED_FOLDERS):
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+atexit.register(_remove_shared_folders)
+
+
+def _dumps_item(arrays, item):
+    try:
+        return False, arrays.dumps(item)
+    except Exception:
+        # fall back to dill for items that can't be pickled
+        return True, arrays.dumps(item, use_dill=True)
+
+
+def _loads_item(arrays, item_s):
+    use_dill, s = item_s
+    # copy-on-write, so that workers modifying their inputs behave as
+    # they would with unpickled copies
+    return arrays.loads(s, mmap_mode='c', use_dill=use_dill)
+
+
+def _load_func(arrays, func_s):
+    """ deserializes a function in a worker, caching it so that it is only loaded once per map
+    """
+    if arrays.folder not in _WORKER_FUNC:
+        _WORKER_FUNC.clear()
+        _WORKER_FUNC[arrays.folder] = arrays.loads(func_s, mmap_mode='c', use_dill=True)
+    return _WORKER_FUNC[arrays.folder]
+
+
+def _call_chunk(func, items, measure=False, instrumented=None):
+    """ runs a function over a chunk of items, returning whether it succeeded along with the results, the time they took, if measured, the peak memory they took and, in another process than the map, the metrics of instrumented functions (or the exception raised, because apply_async does not call its callback for failed tasks)
+
+    instrumented is the value of INSTRUMENT.ENABLED in the process running the map, or None when the chunk runs in that process
+    """
+    if instrumented is not None:
+        old_enabled = INSTRUMENT.ENABLED
+        INSTRUMENT.ENABLED = instrumented
+    try:
+        if measure:
+            memory.reset_peak_rss()
+            baseline = memory.current_rss()
+        start_time = time()
+        results = [func(item) for item in items]
+        seconds = time() - start_time
+        peak = memory.peak_rss() - baseline if measure else None
+        metrics = METRICS.snapshot(reset=True) if instrumented else None
+        return True, (results, seconds, peak, metrics)
+    except Exception as e:
+        return False, e
+    finally:
+        if instrumented is not None:
+            INSTRUMENT.ENABLED = old_enabled
+
+
+def _run_chunk(task):
+    folder, func_s, items_s, measure, instrumented = task
+    arrays = ArrayFolder(folder)
+    try:
+        func = _load_func(arrays, func_s)
+    except Exception as e:
+        return _dumps_outcome((False, e))
+    return _dumps_outcome(_call_chunk(func, (_loads_item(arrays, item_s) for item_s in items_s), measure, instrumented))
+
+
+def _dumps_outcome(outcome):
+    """ pickles the (success, result) pair of a chunk in the worker, since the pool never calls the callback of a task whose result or exception can't be pickled, which would leave the map waiting forever
+    """
+    try:
+        return pickle.dumps(outcome, pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        if outcome[0]:
+            error = Exception("Improper result of parallel map, can't be pickled: {}".format(e))
+        else:
+            error = Exception("Improper exception in parallel map, can't be pickled: {!r}".format(outcome[1]))
+        return pickle.dumps((False, error), pickle.HIGHEST_PROTOCOL)
+
+
+def _run_local_chunk(task):
+    func, items, measure = task
+    PARALLEL_CONTEXT.THREAD_WORKER = True
+    try:
+        return _call_chunk(func, items, measure)
+    finally:
+        PARALLEL_CONTEXT.THREAD_WORKER = False
+
+
+@contextmanager
+def _private_pool(size, backend):
+    pool = _start_pool(backend, size)
+    try:
+        yield pool
+    finally:
+        _terminate(pool)
+
+
+def _map_pool(size, backend):
+    """ context of the pool that a map runs on: the persistent pool of the backend, except for maps nested in workers, which get a pool of their own that is terminated with the map: thread maps in thread workers since their tasks would wait behind the tasks waiting for them in the shared pool, and process maps in process workers so that each worker doesn't keep a pool alive
+    """
+    if ((backend == "thread" and PARALLEL_CONTEXT.THREAD_WORKER)
+            or (backend == "process" and _POOL_WORKER)):
+        return _private_pool(size or n_jobs(), backend)
+    return using_pool(size, backend)
+
+
+@contextmanager
+def _chunk_tasks(func, backend):
+    """ yields the function that runs a chunk of items in a worker of a backend, the function converting a chunk into its argument and the function converting what it returns into a (success, result) pair
+    """
+    if backend == "thread":
+        # threads share memory, so nothing needs to be serialized
+        yield _run_local_chunk, lambda chunk, measure: (func, chunk, measure), lambda outcome: outcome
+    else:
+        with shared_arrays() as arrays:
+            try:
+                func_s = arrays.dumps(func, use_dill=True)
+            except Exception as e:
+                # e.g. functions referencing locks or open files
+                raise PicklingError(e)
+            instrumented = INSTRUMENT.ENABLED
+            yield _run_chunk, lambda chunk, measure: (arrays.folder, func_s, [_dumps_item(arrays, item) for item in chunk], measure, instrumented), pickle.loads
+
+
+class ChunkSizer(object):
+
+    """ picks the number of items to send to a worker at once, so that each chunk takes about PARALLEL.CHUNK_SECONDS, based on the time taken by finished chunks
+
+    starts with single items and at most doubles the size of the largest finished chunk, so that a few fast items don't lead to one huge chunk; uses PARALLEL.CHUNK_SIZE instead if it is set
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.items = 0
+        self.seconds = 0.0
+        self.largest = 0
+
+    def size(self):
+        if PARALLEL.CHUNK_SIZE is not None:
+            return PARALLEL.CHUNK_SIZE
+        elif self.items == 0:
+            size = 1
+        else:
+            seconds_per_item = max(self.seconds / self.items, 1e-6)
+            size = int(PARALLEL.CHUNK_SECONDS / seconds_per_item)
+            size = max(1, min(size, 2 * self.largest))
+        if self.max_size is not None:
+            size = min(size, self.max_size)
+        return size
+
+    def update(self, items, seconds):
+        self.items += items
+        self.seconds += seconds
+        self.largest = max(self.largest, items)
+
+
+def memory_budget():
+    """ bytes of memory that the tasks of a parallel map may use at once, or None if unlimited
+    """
+    budget = PARALLEL.MEMORY_BUDGET
+    if budget is not None and budget <= 1:
+        budget *= memory.total_memory()
+    return budget
+
+
+@contextmanager
+def task_memory(nbytes):
+    """ sets the estimated peak memory of each task of the parallel maps within the context, instead of measuring it
+    """
+    old_task_memory = PARALLEL_CONTEXT.TASK_MEMORY
+    PARALLEL_CONTEXT.TASK_MEMORY = nbytes
+    try:
+        yield
+    finally:
+        PARALLEL_CONTEXT.TASK_MEMORY = old_task_memory
+
+
+class MemoryLimiter(object):
+
+    """ limits the number of chunks running at once so that their memory fits in the memory budget, using the estimated memory of a task from PARALLEL_CONTEXT.TASK_MEMORY or else the peak memory measured while the first chunk runs alone
+    """
+
+    def __init__(self):
+        self.budget = memory_budget()
+        self.estimate = PARALLEL_CONTEXT.TASK_MEMORY
+
+    def measure(self):
+        """ whether the memory of the next chunk should be measured
+        """
+        return self.budget is not None and self.estimate is None
+
+    def max_running(self):
+        if self.budget is None:
+            return float("inf")
+        elif self.estimate is None:
+            return 1
+        else:
+            return max(1, int(self.budget // max(self.estimate, 1)))
+
+    def update(self, peak):
+        if peak is not None:
+            self.estimate = max(self.estimate or 0, peak)
+
+
+def pool_parmap(func, generator, jobs=None, backend="process", n_blas_threads=None, pool_size=None):
+    """ parallel map over the persistent worker pool of a backend
+
+    for the process backend, the function is serialized with dill once per call, so closures and functions defined after the pool was started can be used, and workers keep it deserialized for the rest of the call
+    """
+    items = list(generator)
+    if jobs is None:
+        jobs = n_jobs()
+    # keep enough chunks for all workers to stay busy
+    max_chunk_size = max(1, len(items) // (2 * jobs))
+    return list(pool_imap(func, items, jobs, backend=backend, n_blas_threads=n_blas_threads, max_chunk_size=max_chunk_size, pool_size=pool_size))
+
+
+def pool_imap(func, generator, jobs=None, backend="process", n_blas_threads=None, ordered=True, max_in_flight=None, max_chunk_size=None, pool_size=None):
+    """ generator of the results of a parallel map over the persistent worker pool of a backend, that only reads from the input generator as results are consumed
+
+    at most jobs chunks run at once, on a pool of at least pool_size workers (default: n_jobs()) that is shared with the other maps of the process
+
+    items are sent to workers in chunks sized by a ChunkSizer, and at most max_in_flight chunks (default: PARALLEL.MAX_IN_FLIGHT per worker) are submitted but not yet yielded at any time, so memory use does not grow with the length of the input; when ordered is False, results are yielded as soon as they finish
+
+    with PARALLEL.MEMORY_BUDGET set, a MemoryLimiter also limits how many chunks run at once
+
+    n_blas_threads limits the threads used by BLAS while the map runs, which keeps thread workers from oversubscribing the cores
+    """
+    if jobs is None:
+        jobs = n_jobs()
+    if max_in_flight is None:
+        max_in_flight = PARALLEL.MAX_IN_FLIGHT * jobs
+    sizer = ChunkSizer(max_chunk_size)
+    limiter = MemoryLimiter()
+    finished_queue = queue.Queue()
+    items = iter(generator)
+    exhausted = False
+    submitted = yielded = returned = 0
+    finished = {}
+    with _map_pool(pool_size, backend) as pool, _chunk_tasks(func, backend) as (run_chunk, to_task, from_outcome), blas_threads(n_blas_threads):
+        workers = _live_workers(pool) if backend == "process" else None
+        while True:
+            while (not exhausted
+                   and submitted - yielded < max_in_flight
+                   and submitted - returned < min(jobs, limiter.max_running())):
+                chunk = list(itertools.islice(items, sizer.size()))
+                if not chunk:
+                    exhausted = True
+                    break
+                pool.apply_async(run_chunk,
+                                 (to_task(chunk, limiter.measure()),),
+                                 callback=partial(_put_indexed, finished_queue, submitted))
+                submitted += 1
+            if exhausted and yielded == submitted:
+                return
+            index, outcome = _get_finished(finished_queue, pool, workers)
+            success, result = from_outcome(outcome)
+            returned += 1
+            if not success:
+                raise result
+            results, seconds, peak, metrics = result
+            if metrics:
+                METRICS.merge(metrics)
+            sizer.update(len(results), seconds)
+            limiter.update(peak)
+            if ordered:
+                finished[index] = results
+                while yielded in finished:
+                    yielded += 1
+                    for result in finished.pop(yielded - 1):
+                        yield result
+            else:
+                yielded += 1
+                for result in results:
+                    yield result
+
+
+def _put_indexed(finished_queue, index, result):
+    finished_queue.put((index, result))
+
+
+def _live_workers(pool):
+    return set(worker for worker in pool._pool if worker.exitcode is None)
+
+
+def _get_finished(finished_queue, pool, workers):
+    """ waits for the next finished chunk of a map, raising if one of the workers of a process pool died (e.g. killed for using too much memory), since the chunk it was running never finishes
+
+    workers is the set of workers of the pool that ran chunks of the map, or None for thread pools; the queue is polled so that the wait can be interrupted
+    """
+    while True:
+        try:
+            return finished_queue.get(timeout=_POLL_SECONDS)
+        except queue.Empty:
+            pass
+        if workers is not None:
+            # dead workers are replaced by the pool
+            workers.update(pool._pool)
+            exitcodes = [worker.exitcode for worker in workers if worker.exitcode]
+            if exitcodes:
+                raise Exception("Improper exit of parallel map worker with exit code {}".format(exitcodes[0]))
+
+
+class _WithMetrics(object):
+
+    """ picklable wrapper that runs a function with instrumentation enabled as in the process running the map, returning its result along with the metrics of the instrumented functions it called in another process, which the map merges into its own
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.pid = os.getpid()
+
+    def __call__(self, item):
+        if os.getpid() == self.pid:
+            return self.func(item), None
+        old_enabled = INSTRUMENT.ENABLED
+        INSTRUMENT.ENABLED = True
+        try:
+            result = self.func(item)
+            return result, METRICS.snapshot(reset=True)
+        finally:
+            INSTRUMENT.ENABLED = old_enabled
+
+
+def joblib_parmap(func, generator, jobs=None):
     """ parallel map using joblib, but it pickles input arguments and thus can't be used for dynamically generated functions.
     """
+    if PARALLEL.POOL:
+        return pool_parmap(func, generator, jobs)
+    instrumented = INSTRUMENT.ENABLED
+    if instrumented:
+        func = _WithMetrics(func)
     try:
         new_func = delayed(func)
     except TypeError as e:
         raise PicklingError(e)
-    return joblib_run(new_func(item) for item in generator)
+    results = joblib_run((new_func(item) for item in generator), jobs)
+    if not instrumented:
+        return results
+    for _, metrics in results:
+        if metrics:
+            METRICS.merge(metrics)
+    return [result for result, _ in results]
 
 
-def joblib_run(delayed_generator):
+def joblib_run(delayed_generator, jobs=None):
     """ runs a generator of joblib tasks
     NOTE: the functions run do not have to be homogeneous, you can make arbitrary generators with whatever functions as long as they are pickle-able
     """
-    return Parallel(n_jobs=PARALLEL.JOBS, verbose=PARALLEL.JOBLIB_VERBOSE, pre_dispatch=PARALLEL.JOBLIB_PRE_DISPATCH)(delayed_generator)
+    if jobs is None:
+        jobs = PARALLEL.JOBS
+    batch_size = 'auto' if PARALLEL.CHUNK_SIZE is None else PARALLEL.CHUNK_SIZE
+    return Parallel(n_jobs=jobs, verbose=PARALLEL.JOBLIB_VERBOSE, pre_dispatch=PARALLEL.JOBLIB_PRE_DISPATCH, batch_size=batch_size)(delayed_generator)
 
 
-def no_pickle_parmap(func, generator):
+def no_pickle_parmap(func, generator, jobs=None):
     """ alternative parallel map that allows for unpicklable items by using pipes
 
     source: http://stackoverflow.com/questions/3288595/multiprocessing-using-pool-map-on-a-function-defined-in-a-class
     """
+    if PARALLEL.POOL:
+        return pool_parmap(func, generator, jobs)
+    return _fork_parmap(func, generator, jobs)
+
+
+def _fork_parmap(func, generator, jobs=None):
+    """ parallel map over processes forked for the call, so that the function is not serialized
+    """
     def spawn(func):
         def fun(q_in, q_out):
+            _init_worker()
             while True:
                 i, x = q_in.get()
                 if i is None:
                     break
-                q_out.put((i, func(x)))
+                results = [func(_loads_item(arrays, item_s)) for item_s in x]
+                # calls of instrumented functions in this worker
+                metrics = METRICS.snapshot(reset=True) if INSTRUMENT.ENABLED else None
+                q_out.put((i, results, metrics))
         return fun
 
-    n_jobs = multiprocessing.cpu_count() if PARALLEL.JOBS == -1 else PARALLEL.JOBS
+    if jobs is None:
+        jobs = n_jobs()
+
+    # the time items take can't be measured before they are all sent, so
+    # items are sent in a fixed number of chunks per worker
+    items = list(generator)
+    chunk_size = PARALLEL.CHUNK_SIZE or max(1, len(items) // (4 * jobs))
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
 
     q_in = multiprocessing.Queue(1)
     q_out = multiprocessing.Queue()
 
-    proc = [multiprocessing.Process(target=spawn(func), args=(q_in, q_out)) for _ in range(n_jobs)]
-    for p in proc:
-        p.daemon = True
-        p.start()
+    with shared_arrays() as arrays:
+        proc = [multiprocessing.Process(target=spawn(func), args=(q_in, q_out)) for _ in range(jobs)]
+        for p in proc:
+            p.daemon = True
+            p.start()
 
-    sent = [q_in.put((i, x)) for i, x in enumerate(generator)]
-    [q_in.put((None, None)) for _ in range(n_jobs)]
-    res = [q_out.get() for _ in range(len(sent))]
+        sent = [q_in.put((i, [_dumps_item(arrays, item) for item in chunk])) for i, chunk in enumerate(chunks)]
+        [q_in.put((None, None)) for _ in range(jobs)]
+        res = [q_out.get() for _ in range(len(sent))]
 
-    [p.join() for p in proc]
+        [p.join() for p in proc]
 
-    return [x for i, x in sorted(res)]
+    for _, _, metrics in res:
+        if metrics:
+            METRICS.merge(metrics)
+    return [x for i, xs, _ in sorted(res) for x in xs]
+
+
+def _blas_threads(backend, budget, jobs):
+    """ number of BLAS threads for each task of a map, or None to leave BLAS as is
+    """
+    if backend == "thread" and PARALLEL.THREAD_BLAS_LIMIT:
+        return max(1, budget // jobs)
+    return None
 
 
 def pmap(func, generator, *args, **kwargs):
-    """ parallel map that only parallelizes if not already within a pmap
+    """ parallel map that splits the cores available to it among its items, so that parallel maps within them only use the cores left unused
+
+    the backend can be chosen with PARALLEL.BACKEND, or for the calls within a use_backend context
     """
     new_func = partial(func, *args, **kwargs) if args or kwargs else func
     if not PARALLEL.PMAP:
-        return map(new_func, generator)
-    else:
-        # don't allow parallel maps under this to parallelize
-        # because computation is already in parallel
-        PARALLEL.PMAP = False
-        try:
-            return joblib_parmap(new_func, generator)
-        except PicklingError as e:
-            # allow parallel maps under this to try to perform
-            # in parallel
-            print("PicklingError: {}".format(e))
-            return no_pickle_parmap(new_func, generator)
-        finally:
-            PARALLEL.PMAP = True
+        return list(map(new_func, generator))
+    backend = current_backend()
+    if backend == "cluster":
+        from boomlet.cluster import cluster_map
+        # workers of the cluster have core budgets of their own
+        return cluster_map(new_func, generator)
+    budget = available_cores()
+    if budget <= 1:
+        return list(map(new_func, generator))
+    items = list(generator)
+    jobs = min(budget, len(items))
+    task_func = WithCores(new_func, budget // max(jobs, 1), backend)
+    if jobs <= 1:
+        return list(map(task_func, items))
+    if backend == "thread":
+        return pool_parmap(task_func, items, jobs, backend, _blas_threads(backend, budget, jobs), budget)
+    try:
+        if PARALLEL.POOL:
+            return pool_parmap(task_func, items, jobs, pool_size=budget)
+        return joblib_parmap(task_func, items, jobs)
+    except PicklingError as e:
+        # even dill can't serialize some functions, which forked processes
+        # inherit instead
+        print("PicklingError: {}".format(e))
+        return _fork_parmap(task_func, items, jobs)
+
+
+def _pimap(func, generator, args, kwargs, ordered):
+    new_func = partial(func, *args, **kwargs) if args or kwargs else func
+    if not PARALLEL.PMAP:
+        return (new_func(item) for item in generator)
+    backend = current_backend()
+    if backend == "cluster":
+        from boomlet.cluster import cluster_imap
+        return cluster_imap(new_func, generator, ordered)
+    budget = available_cores()
+    if budget <= 1:
+        return (new_func(item) for item in generator)
+    # the number of items is unknown, so all cores are used for workers
+    return pool_imap(WithCores(new_func, 1, backend), generator, budget, backend, _blas_threads(backend, budget, budget), ordered, pool_size=budget)
+
+
+class WithSeed(object):
+
+    """ wraps a function of an item into a function of a (seed, item) pair, that runs with random and numpy.random seeded with the seed
+    """
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, seeded_item):
+        seed, item = seeded_item
+        with seed_random(seed):
+            return self.func(item)
+
+
+def seeded_pmap(func, generator, seed, *args, **kwargs):
+    """ pmap where the i-th item runs with random and numpy.random seeded with the i-th seed spawned from seed, so that results only depend on the seed and not on the number of jobs or how items are chunked
+
+    with the thread backend, the global random state is shared by all threads, so results are only reproducible if functions don't use it; functions can instead create their own generators from seeds of spawn_seeds
+    """
+    new_func = partial(func, *args, **kwargs) if args or kwargs else func
+    items = list(generator)
+    return pmap(WithSeed(new_func), zip(spawn_seeds(seed, len(items)), items))
+
+
+def pimap(func, generator, *args, **kwargs):
+    """ lazy version of pmap, that yields results in order while keeping a bounded number of items in flight
+    """
+    return _pimap(func, generator, args, kwargs, ordered=True)
+
+
+def pimap_unordered(func, generator, *args, **kwargs):
+    """ lazy version of pmap, that yields results in the order they finish while keeping a bounded number of items in flight
+    """
+    return _pimap(func, generator, args, kwargs, ordered=False)
@@ -11,25 +11,32 @@ class SGDRanker(BaseEstimator):
 
     """ Ranking predictor using stochastic gradient descent
 
+    Trains for a number of seconds, or on n_iter pairs of rows if given, which is reproducible with a random_state.
+
     TODO:
     -allow configurable parameters for classifier
-    -seed random state
     """
 
-    def __init__(self, seconds=10):
-        self.clf = SGDClassifier(loss='hinge')
+    def __init__(self, seconds=10, n_iter=None, random_state=None):
+        self.clf = SGDClassifier(loss='hinge', random_state=random_state)
         self.clf.fit_intercept = False
         self.clf.classes_ = np.array([-1, 1])
         self.seconds = seconds
+        self.n_iter = n_iter
+        self.random_state = random_state
 
     def fit(self, X, y):
         rows = X.shape[0]
+        rng = random if self.random_state is None else random.Random(self.random_state)
         start_time = time.time()
         for i in itertools.count():
-            if time.time() - start_time > self.seconds:
+            if self.n_iter is not None:
+                if i >= self.n_iter:
+                    return self
+            elif time.time() - start_time > self.seconds:
                 return self
-            idx1 = random.randint(0, rows - 1)
-            idx2 = random.randint(0, rows - 1)
+            idx1 = rng.randint(0, rows - 1)
+            idx2 = rng.randint(0, rows - 1)
             y1, y2 = y[idx1], y[idx2]
             if y1 == y2:
                 continue
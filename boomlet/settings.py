@@ -1,11 +1,83 @@
+import threading
+
+
 class Setting(object):
     pass
 
+
+class LocalSetting(threading.local):
+    """ settings with a separate value for each thread; class attributes are the initial values in every thread
+    """
+    pass
+
 PARALLEL = Setting()
 PARALLEL.JOBS = -1
 PARALLEL.JOBLIB_VERBOSE = 0
 PARALLEL.JOBLIB_PRE_DISPATCH = 'n_jobs'
+# set to False to disable parallel maps
 PARALLEL.PMAP = True
+# reuse a lazily started worker pool across pmap calls instead of starting
+# new workers on every call
+PARALLEL.POOL = True
+# arrays of at least this many bytes are sent to workers as memory-mapped
+# files instead of being pickled into every task (None to disable)
+PARALLEL.SHARED_ARRAY_NBYTES = 1e6
+# folder for the memory-mapped files (default: /dev/shm if it exists and has
+# room, else the system temporary folder)
+PARALLEL.TEMP_FOLDER = None
+# bytes that must stay free in /dev/shm after an array is written to it,
+# otherwise the array is written to the system temporary folder, so that small
+# shared memory filesystems (e.g. docker's default of 64MB) don't fill up
+PARALLEL.SHM_MIN_FREE = 1e9
+# chunks of items per worker that are submitted but not yet yielded
+PARALLEL.MAX_IN_FLIGHT = 2
+# number of items sent to a worker at once (None to pick it from the time
+# finished chunks took, so that each chunk takes about PARALLEL.CHUNK_SECONDS)
+PARALLEL.CHUNK_SIZE = None
+PARALLEL.CHUNK_SECONDS = 0.2
+# memory that the tasks of a parallel map may use at once, in bytes or as a
+# fraction of the machine's memory (None for no limit); the memory of a task
+# is measured on the first chunk, unless set with parallel.task_memory
+PARALLEL.MEMORY_BUDGET = None
+# "process", "thread" or "cluster"; threads avoid copying inputs and
+# results, and are faster for work that releases the GIL, such as numpy and
+# BLAS calls; "cluster" runs tasks on workers connected over TCP (see
+# boomlet.cluster)
+PARALLEL.BACKEND = "process"
+# limit BLAS threads to the cores of each task when using threads (requires
+# threadpoolctl)
+PARALLEL.THREAD_BLAS_LIMIT = True
+# address and key that the coordinator of the cluster backend listens with;
+# anyone with the key can run code on the coordinator, so it must be set to
+# listen on other interfaces than loopback (if None, a random key is
+# generated, see cluster.get_authkey)
+PARALLEL.CLUSTER_ADDRESS = ("127.0.0.1", 50000)
+PARALLEL.CLUSTER_AUTHKEY = None
+# seconds between heartbeats of cluster workers, and seconds without a
+# heartbeat after which a worker is presumed dead and its tasks are sent to
+# other workers
+PARALLEL.CLUSTER_HEARTBEAT = 5
+PARALLEL.CLUSTER_TIMEOUT = 30
+
+
+
+class ParallelContext(LocalSetting):
+    # number of cores that parallel maps within the current task may use
+    # (None for PARALLEL.JOBS); each pmap splits its cores among its items
+    CORES = None
+    # backend of parallel maps (None for PARALLEL.BACKEND)
+    BACKEND = None
+    # estimated peak memory of each task in bytes (None to measure it)
+    TASK_MEMORY = None
+    # whether the current thread is a worker of a thread backend map
+    THREAD_WORKER = False
+
+# state of the parallel map that the current task runs in
+PARALLEL_CONTEXT = ParallelContext()
+
+INSTRUMENT = Setting()
+# record the calls of functions decorated with decorators.instrument
+INSTRUMENT.ENABLED = False
 
 GAP_STATISTIC = Setting()
 GAP_STATISTIC.RANDOMIZED_PCA_THRESHOLD = 10
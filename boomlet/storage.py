@@ -6,8 +6,24 @@ import joblib
 import zlib
 import os
 import glob
+import fcntl
+import bisect
+import shutil
+import struct
+import json
+import hashlib
+import tempfile
+import types
+import functools
+from io import BytesIO
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 import dill
+import numpy as np
+
+from boomlet.utils.array import array_hash
 
 
 def mkdir(filename):
@@ -33,25 +49,306 @@ def reads(filename):
         return infile.read()
 
 
+@contextmanager
+def file_lock(filename):
+    """ holds an exclusive lock on a file, created if needed, for the duration of the context; the lock is shared with other processes
+    """
+    mkdir(filename)
+    with open(filename, 'a') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+# chunked compression format: the magic string, then frames of
+# (compressed length, raw length, zlib data), an empty frame, an index of
+# (frame offset, raw offset) pairs and a trailer pointing to the index
+CHUNKED_MAGIC = b"BMZ1"
+_FRAME = struct.Struct("<II")
+_INDEX_ENTRY = struct.Struct("<QQ")
+_TRAILER = struct.Struct("<QQ4s")
+
+
+def _default_threads():
+    # imported here since parallel imports this module
+    from boomlet.parallel import available_cores
+    return available_cores()
+
+
+class ChunkedWriter(object):
+
+    """ file-like object that compresses what is written to it in chunks, compressing several chunks at once in threads (zlib releases the GIL)
+
+    close must be called (or the writer used as a context manager) to write the last chunk and the index; the underlying file is not closed
+    """
+
+    def __init__(self, outfile, level=6, chunk_size=1 << 22, threads=None):
+        self.outfile = outfile
+        self.level = level
+        self.chunk_size = chunk_size
+        self.threads = _default_threads() if threads is None else threads
+        self.pool = ThreadPool(self.threads) if self.threads > 1 else None
+        self.pending = deque()
+        self.buffer = []
+        self.buffer_size = 0
+        self.raw_offset = 0
+        self.offset = len(CHUNKED_MAGIC)
+        self.index = []
+        self.outfile.write(CHUNKED_MAGIC)
+
+    def write(self, s):
+        if not isinstance(s, (bytes, bytearray)):
+            # e.g. the pickle.PickleBuffer that protocol 5 pickling writes
+            # the data of arrays with, which has no len
+            s = memoryview(s).cast("B")
+        self.buffer.append(s)
+        self.buffer_size += len(s)
+        if self.buffer_size >= self.chunk_size:
+            data = b"".join(self.buffer)
+            for start in range(0, len(data) - self.chunk_size + 1, self.chunk_size):
+                self._submit(data[start:start + self.chunk_size])
+            rest = data[start + self.chunk_size:]
+            self.buffer = [rest]
+            self.buffer_size = len(rest)
+
+    def _submit(self, chunk):
+        if self.pool is None:
+            self._write_frame(len(chunk), zlib.compress(chunk, self.level))
+            return
+        self.pending.append((len(chunk), self.pool.apply_async(zlib.compress, (chunk, self.level))))
+        # bound the memory of chunks waiting to be written
+        while len(self.pending) > 2 * self.threads:
+            self._write_pending()
+
+    def _write_pending(self):
+        raw_size, result = self.pending.popleft()
+        self._write_frame(raw_size, result.get())
+
+    def _write_frame(self, raw_size, compressed):
+        self.index.append(_INDEX_ENTRY.pack(self.offset, self.raw_offset))
+        self.outfile.write(_FRAME.pack(len(compressed), raw_size))
+        self.outfile.write(compressed)
+        self.offset += _FRAME.size + len(compressed)
+        self.raw_offset += raw_size
+
+    def close(self):
+        if self.buffer_size:
+            self._submit(b"".join(self.buffer))
+            self.buffer = []
+            self.buffer_size = 0
+        while self.pending:
+            self._write_pending()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.outfile.write(_FRAME.pack(0, 0))
+        index_offset = self.offset + _FRAME.size
+        self.outfile.write(b"".join(self.index))
+        self.outfile.write(_TRAILER.pack(index_offset, len(self.index), CHUNKED_MAGIC))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ChunkedReader(object):
+
+    """ file-like object that decompresses a file written by ChunkedWriter as a stream, one chunk at a time
+
+    if the compressed data runs until the end of a seekable file, chunks can also be read in any order with read_chunk and read_at
+    """
+
+    def __init__(self, infile):
+        self.infile = infile
+        magic = infile.read(len(CHUNKED_MAGIC))
+        if magic != CHUNKED_MAGIC:
+            raise Exception("Improper chunked compression magic: {!r}".format(magic))
+        self.start = infile.tell() - len(CHUNKED_MAGIC)
+        self.done = False
+        self.buffer = b""
+        self.pos = 0
+        self._index = None
+
+    def _read_frame(self, infile):
+        compressed_size, raw_size = _FRAME.unpack(infile.read(_FRAME.size))
+        if compressed_size == 0:
+            return None
+        chunk = zlib.decompress(infile.read(compressed_size))
+        assert len(chunk) == raw_size
+        return chunk
+
+    def _next_chunk(self):
+        if not self.done:
+            chunk = self._read_frame(self.infile)
+            if chunk is not None:
+                return chunk
+            self.done = True
+        return b""
+
+    def read(self, size=-1):
+        parts = []
+        if size is None or size < 0:
+            parts.append(self.buffer[self.pos:])
+            chunk = self._next_chunk()
+            while chunk:
+                parts.append(chunk)
+                chunk = self._next_chunk()
+            self.buffer, self.pos = b"", 0
+            return b"".join(parts)
+        while size > 0:
+            if self.pos >= len(self.buffer):
+                self.buffer, self.pos = self._next_chunk(), 0
+                if not self.buffer:
+                    break
+            part = self.buffer[self.pos:self.pos + size]
+            self.pos += len(part)
+            size -= len(part)
+            parts.append(part)
+        return b"".join(parts)
+
+    def readline(self):
+        parts = []
+        while True:
+            if self.pos >= len(self.buffer):
+                self.buffer, self.pos = self._next_chunk(), 0
+                if not self.buffer:
+                    break
+            end = self.buffer.find(b"\n", self.pos)
+            if end >= 0:
+                parts.append(self.buffer[self.pos:end + 1])
+                self.pos = end + 1
+                break
+            parts.append(self.buffer[self.pos:])
+            self.pos = len(self.buffer)
+        return b"".join(parts)
+
+    @property
+    def index(self):
+        """ list of (frame offset, raw offset) pairs of the chunks
+        """
+        if self._index is None:
+            position = self.infile.tell()
+            try:
+                self.infile.seek(-_TRAILER.size, os.SEEK_END)
+                index_offset, n_chunks, magic = _TRAILER.unpack(self.infile.read(_TRAILER.size))
+                if magic != CHUNKED_MAGIC:
+                    raise Exception("Improper chunked compression trailer: {!r}".format(magic))
+                self.infile.seek(self.start + index_offset)
+                data = self.infile.read(n_chunks * _INDEX_ENTRY.size)
+                self._index = [_INDEX_ENTRY.unpack_from(data, i * _INDEX_ENTRY.size)
+                               for i in range(n_chunks)]
+            finally:
+                self.infile.seek(position)
+        return self._index
+
+    def __len__(self):
+        return len(self.index)
+
+    def read_chunk(self, i):
+        """ decompresses the i-th chunk
+        """
+        position = self.infile.tell()
+        try:
+            self.infile.seek(self.start + self.index[i][0])
+            return self._read_frame(self.infile)
+        finally:
+            self.infile.seek(position)
+
+    def read_at(self, offset, size):
+        """ reads size bytes of the decompressed data starting at an offset, only decompressing the chunks that overlap it
+        """
+        raw_offsets = [raw_offset for _, raw_offset in self.index]
+        i = max(bisect.bisect_right(raw_offsets, offset) - 1, 0)
+        parts = []
+        start = offset - raw_offsets[i] if raw_offsets else 0
+        while size > 0 and i < len(raw_offsets):
+            part = self.read_chunk(i)[start:start + size]
+            parts.append(part)
+            size -= len(part)
+            start = 0
+            i += 1
+        return b"".join(parts)
+
+
+@contextmanager
+def atomic_write(filename):
+    """ yields a temporary filename in the same folder as filename, that is renamed to filename once the context exits without an exception, so that readers never see a partially written file
+    """
+    mkdir(filename)
+    dirname, basename = os.path.split(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(prefix="." + basename + ".", suffix=".tmp", dir=dirname)
+    os.close(fd)
+    try:
+        yield tmp_filename
+        os.rename(tmp_filename, filename)
+    finally:
+        if exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
 def compress(s, level=9):
     return zlib.compress(s, level)
 
 
+def compress_chunked(s, level=6, chunk_size=1 << 22, threads=None):
+    """ compresses a string in the chunked format, compressing chunks in parallel threads
+    """
+    outfile = BytesIO()
+    with ChunkedWriter(outfile, level, chunk_size, threads) as writer:
+        writer.write(s)
+    return outfile.getvalue()
+
+
 def decompress(s):
+    """ decompresses a string from compress or compress_chunked
+    """
+    if s[:len(CHUNKED_MAGIC)] == CHUNKED_MAGIC:
+        return ChunkedReader(BytesIO(s)).read()
     return zlib.decompress(s)
 
 
+@contextmanager
+def _open_write(filename, compress):
+    with open(filename, 'wb') as outfile:
+        if compress:
+            with ChunkedWriter(outfile, level=compress) as writer:
+                yield writer
+        else:
+            yield outfile
+
+
+@contextmanager
+def _open_read(filename):
+    # files in the chunked format are detected by their magic string
+    with open(filename, 'rb') as infile:
+        magic = infile.read(len(CHUNKED_MAGIC))
+        infile.seek(0)
+        if magic == CHUNKED_MAGIC:
+            yield ChunkedReader(infile)
+        else:
+            yield infile
+
+
 def pickle_load(filename):
     """
     if this fails with a core dump, one may still be able to load a
     pickle by importing pickle instead of cPickle
     """
-    with open(filename) as infile:
+    with _open_read(filename) as infile:
         return pickle.load(infile)
 
 
-def pickle_dump(filename, obj):
-    with open(filename, 'w') as outfile:
+def pickle_dump(filename, obj, compress=0):
+    """
+    compress is the zlib level (0 for none) of the chunked compression
+    format, which is compressed in parallel threads
+    """
+    with _open_write(filename, compress) as outfile:
         pickle.dump(obj, outfile, pickle.HIGHEST_PROTOCOL)
 
 
@@ -67,17 +364,25 @@ def joblib_load(filename, mmap_mode='r'):
     return joblib.load(filename, mmap_mode)
 
 
-def joblib_dump(filename, obj, compress=0):
+def joblib_dump(filename, obj, compress=0, atomic=False):
+    """
+    if atomic, the file is written under a temporary name and renamed into
+    place, so that it is either complete or missing
+    """
+    if atomic:
+        with atomic_write(filename) as tmp_filename:
+            joblib.dump(obj, tmp_filename, compress)
+        return [filename]
     return joblib.dump(obj, filename, compress)
 
 
 def dill_load(filename):
-    with open(filename) as infile:
+    with _open_read(filename) as infile:
         return dill.load(infile)
 
 
-def dill_dump(filename, obj):
-    with open(filename, 'w') as outfile:
+def dill_dump(filename, obj, compress=0):
+    with _open_write(filename, compress) as outfile:
         dill.dump(obj, outfile)
 
 
@@ -89,6 +394,235 @@ def dill_dumps(obj):
     return dill.dumps(obj)
 
 
+class ArrayFolder(object):
+
+    """ pickles objects with large arrays moved out into .npy files in a folder, so that they can be loaded back memory-mapped instead of copied
+
+    the folder is only created once an array is saved to it, and the same array object is only saved once no matter how many times it is pickled
+    """
+
+    def __init__(self, folder, min_nbytes=0):
+        self.folder = folder
+        self.min_nbytes = min_nbytes
+        self.filenames = {}
+        # keep references so that ids of saved arrays are not reused
+        self.arrays = []
+
+    def array_folder(self, obj):
+        """ folder that an array is saved to; arrays saved outside of the folder are referred to by absolute paths
+        """
+        return self.folder
+
+    def persistent_id(self, obj):
+        if (type(obj) in (np.ndarray, np.memmap)
+                and not obj.dtype.hasobject
+                and obj.nbytes >= self.min_nbytes):
+            key = id(obj)
+            if key not in self.filenames:
+                filename = "{}.npy".format(len(self.filenames))
+                folder = self.array_folder(obj)
+                path = os.path.join(folder, filename)
+                mkdir(path)
+                np.save(path, obj)
+                self.filenames[key] = filename if folder == self.folder else path
+                self.arrays.append(obj)
+            return self.filenames[key]
+        return None
+
+    def persistent_load(self, filename, mmap_mode='r'):
+        return np.load(os.path.join(self.folder, filename), mmap_mode=mmap_mode)
+
+    def dumps(self, obj, use_dill=False):
+        outfile = BytesIO()
+        if use_dill:
+            pickler = dill.Pickler(outfile, pickle.HIGHEST_PROTOCOL, recurse=True)
+        else:
+            pickler = pickle.Pickler(outfile, pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = self.persistent_id
+        pickler.dump(obj)
+        return outfile.getvalue()
+
+    def loads(self, s, mmap_mode='r', use_dill=False):
+        infile = BytesIO(s)
+        if use_dill:
+            unpickler = dill.Unpickler(infile)
+        else:
+            unpickler = pickle.Unpickler(infile)
+        unpickler.persistent_load = lambda filename: self.persistent_load(filename, mmap_mode)
+        return unpickler.load()
+
+
+# version of the model store format written by model_dump
+MODEL_FORMAT = 1
+
+
+def model_dump(dirname, obj, min_nbytes=1e4, use_dill=False):
+    """ saves an object, such as a fitted estimator, into a folder with its arrays of at least min_nbytes as separate .npy files next to a pickle of the rest of the object and a JSON manifest
+
+    the folder is written under a temporary name and renamed into place, replacing an existing one; processes that already loaded the old arrays keep them
+    """
+    dirname = os.path.abspath(dirname)
+    mkdir(dirname)
+    tmp_dirname = tempfile.mkdtemp(prefix=".tmp-", dir=os.path.dirname(dirname))
+    try:
+        folder = ArrayFolder(tmp_dirname, min_nbytes)
+        with open(os.path.join(tmp_dirname, "object.pkl"), 'wb') as outfile:
+            outfile.write(folder.dumps(obj, use_dill))
+        filenames = sorted(folder.filenames.values(), key=lambda f: int(f.split(".")[0]))
+        manifest = dict(
+            format=MODEL_FORMAT,
+            type="{}.{}".format(type(obj).__module__, type(obj).__name__),
+            use_dill=use_dill,
+            arrays=[dict(filename=filename,
+                         shape=arr.shape,
+                         dtype=arr.dtype.str,
+                         nbytes=int(arr.nbytes))
+                    for filename, arr in zip(filenames, folder.arrays)],
+        )
+        writes(os.path.join(tmp_dirname, "manifest.json"), json.dumps(manifest, indent=2))
+        if exists(dirname):
+            shutil.rmtree(dirname)
+        os.rename(tmp_dirname, dirname)
+    finally:
+        shutil.rmtree(tmp_dirname, ignore_errors=True)
+
+
+def model_load(dirname, mmap_mode='r'):
+    """ loads an object saved with model_dump, with its arrays memory-mapped, so that processes loading the same model share its memory
+
+    the arrays are read-only with mmap_mode 'r'; use 'c' for arrays that can be modified in memory or None to read them into memory
+    """
+    manifest = json.loads(reads(os.path.join(dirname, "manifest.json")))
+    if manifest["format"] != MODEL_FORMAT:
+        raise Exception("Improper model format: {}".format(manifest["format"]))
+    with open(os.path.join(dirname, "object.pkl"), 'rb') as infile:
+        s = infile.read()
+    return ArrayFolder(dirname).loads(s, mmap_mode, manifest["use_dill"])
+
+
+def _code_key(code):
+    consts = [_code_key(c) if isinstance(c, types.CodeType) else repr(c)
+              for c in code.co_consts]
+    return repr((code.co_code, consts, code.co_names))
+
+
+def _param_key(value):
+    """ repr of an estimator parameter that is the same in every process, unlike the repr of functions and other objects, which contains their address: functions and classes are identified by their module and name (and lambdas and closures also by their code and closure), arrays by their hash and estimators by their parameters
+    """
+    if isinstance(value, np.ndarray):
+        return "array:" + array_hash(value)
+    elif isinstance(value, dict):
+        return "{" + ", ".join(repr(k) + ": " + _param_key(v) for k, v in sorted(value.items())) + "}"
+    elif isinstance(value, (list, tuple)):
+        return type(value).__name__ + "(" + ", ".join(_param_key(v) for v in value) + ")"
+    elif isinstance(value, functools.partial):
+        return "partial({}, {}, {})".format(_param_key(value.func), _param_key(value.args), _param_key(value.keywords or {}))
+    elif isinstance(value, types.FunctionType):
+        closure = [cell.cell_contents for cell in value.__closure__ or ()]
+        return "{}.{}:{}".format(value.__module__, getattr(value, "__qualname__", value.__name__), hashlib.md5((_code_key(value.__code__) + _param_key([value.__defaults__, closure])).encode()).hexdigest())
+    elif isinstance(value, type) or callable(value) and hasattr(value, "__name__"):
+        # classes, builtins and ufuncs
+        module = getattr(value, "__module__", None) or type(value).__module__
+        return "{}.{}".format(module, getattr(value, "__qualname__", value.__name__))
+    elif hasattr(value, "get_params"):
+        return _param_key(type(value)) + _param_key(value.get_params(deep=False))
+    elif type(value).__repr__ is object.__repr__ and hasattr(value, "__dict__"):
+        return _param_key(type(value)) + _param_key(vars(value))
+    else:
+        return repr(value)
+
+
+class EstimatorCache(object):
+
+    """ on-disk cache of fitted estimators, keyed by the class and parameters of the estimator and a sampled hash of the data it is fit on
+
+    estimators are saved with joblib_dump and loaded back memory-mapped; when the cache is larger than max_bytes, the least recently used estimators are deleted
+
+    several processes can use the same folder at once: entries are written to a temporary folder and renamed into place, and reads, renames and evictions hold a lock on the folder
+    """
+
+    def __init__(self, folder, max_bytes=None, sample_size=10000, mmap_mode='r'):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.sample_size = sample_size
+        self.mmap_mode = mmap_mode
+        self.lock_file = os.path.join(folder, ".lock")
+
+    def key(self, clf, X, y=None):
+        h = hashlib.md5()
+        h.update("{}.{}".format(type(clf).__module__, type(clf).__name__).encode())
+        h.update(_param_key(clf.get_params(deep=False)).encode())
+        h.update(array_hash(X, self.sample_size).encode())
+        if y is not None:
+            h.update(array_hash(y, self.sample_size).encode())
+        return h.hexdigest()
+
+    def _filename(self, path):
+        return os.path.join(path, "estimator.pkl")
+
+    def load(self, key):
+        """ returns the cached estimator for a key, or None if it is not cached
+        """
+        path = os.path.join(self.folder, key)
+        with file_lock(self.lock_file):
+            if not exists(path):
+                return None
+            try:
+                clf = joblib_load(self._filename(path), self.mmap_mode)
+            except Exception:
+                # an unreadable entry is treated as missing
+                shutil.rmtree(path, ignore_errors=True)
+                return None
+            # the modification time marks the last use
+            os.utime(path, None)
+            return clf
+
+    def save(self, key, clf):
+        path = os.path.join(self.folder, key)
+        mkdir(self.lock_file)
+        tmp_path = tempfile.mkdtemp(prefix=".tmp-", dir=self.folder)
+        try:
+            joblib_dump(self._filename(tmp_path), clf)
+            with file_lock(self.lock_file):
+                if not exists(path):
+                    os.rename(tmp_path, path)
+                self._evict()
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def fit(self, clf, X, y=None):
+        """ returns an estimator fit on X and y, loaded from the cache if it was fit on the same data before, else fitting clf and caching it
+        """
+        key = self.key(clf, X, y)
+        cached = self.load(key)
+        if cached is not None:
+            return cached
+        if y is None:
+            clf.fit(X)
+        else:
+            clf.fit(X, y)
+        self.save(key, clf)
+        return clf
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+        entries = []
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if name.startswith(".") or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, filename))
+                       for filename in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
 def glob_one(*args):
     if len(args) == 1:
         dirname = "."
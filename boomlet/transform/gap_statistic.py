@@ -9,6 +9,7 @@ from sklearn.cluster import MiniBatchKMeans
 from sklearn.decomposition import RandomizedPCA, PCA
 
 from boomlet.settings import GAP_STATISTIC
+from boomlet.contextmanagers import span
 
 
 def gap_statistic(x, random_datasets=64):
@@ -24,21 +25,24 @@ def gap_statistic(x, random_datasets=64):
     else:
         pca = PCA()
 
-    pca.fit(x)
-    transformed = pca.transform(x)
+    with span("pca"):
+        pca.fit(x)
+        transformed = pca.transform(x)
 
-    reference_datasets = [pca.inverse_transform(generate_random_dataset(transformed)) for _ in range(random_datasets)]
+    with span("reference datasets"):
+        reference_datasets = [pca.inverse_transform(generate_random_dataset(transformed)) for _ in range(random_datasets)]
 
     max_gap_statistic = -1
     best_num_clusters = 1
 
     for num_clusters in range(1, x.shape[0] + 1):
-        kmeans = MiniBatchKMeans(num_clusters)
-        kmeans.fit(x)
+        with span("kmeans"):
+            kmeans = MiniBatchKMeans(num_clusters)
+            kmeans.fit(x)
 
-        trained_dispersion = dispersion(kmeans, x)
-
-        random_dispersions = [dispersion(kmeans, data) for data in reference_datasets]
+        with span("dispersions"):
+            trained_dispersion = dispersion(kmeans, x)
+            random_dispersions = [dispersion(kmeans, data) for data in reference_datasets]
 
         gap_statistic = np.log(sum(random_dispersions) / random_datasets) - np.log(trained_dispersion)
 
@@ -82,9 +86,12 @@ class FitClusterer(BaseEstimator, TransformerMixin):
         self.clusterer_ = None
 
     def fit(self, X, y=None):
-        num_clusters = max(gap_statistic(X), self.min_clusters)
-        self.clusterer_ = self.clusterer(num_clusters)
-        self.clusterer_.fit(X, y)
+        with span("FitClusterer.fit"):
+            with span("gap_statistic"):
+                num_clusters = max(gap_statistic(X), self.min_clusters)
+            with span("clusterer"):
+                self.clusterer_ = self.clusterer(num_clusters)
+                self.clusterer_.fit(X, y)
         return self
 
     def fit_predict(self, X, y=None):
@@ -1,6 +1,7 @@
 import math
 import numpy as np
 from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.utils import check_random_state
 
 from boomlet.utils.estimators import gaussian_kernel_median_trick
 
@@ -14,22 +15,25 @@ class RandomizedFourierKernel(BaseEstimator, TransformerMixin):
     -Scale and perform PCA
     -Estimate kernel bandwidth with the 'median trick'
     -Perform Logistic Regression w/ L2 loss
-
-    TODO:
-    -seed random state
     """
 
-    def __init__(self, n_components=100, scale=None):
+    def __init__(self, n_components=100, scale=None, median_sample_size='sqrt',
+                 random_state=None):
         self.n_components = n_components
         self.scale = scale
+        self.median_sample_size = median_sample_size
+        self.random_state = random_state
 
     def fit(self, X, y=None):
+        rng = check_random_state(self.random_state)
         if self.scale is not None:
             self.scale_ = self.scale
         else:
-            self.scale_ = gaussian_kernel_median_trick(X)
-        self.r_ = np.random.randn(X.shape[0], self.n_components)
-        self.b_ = 2 * math.pi * np.random.uniform(size=self.n_components)
+            self.scale_ = gaussian_kernel_median_trick(X,
+                                                       self.median_sample_size,
+                                                       random_state=rng)
+        self.r_ = rng.randn(X.shape[1], self.n_components)
+        self.b_ = 2 * math.pi * rng.uniform(size=self.n_components)
         return self
 
     def transform(self, X):
@@ -3,8 +3,7 @@ from copy import deepcopy
 from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.preprocessing import LabelBinarizer
 
-from boomlet.utils.collection import group_by
-from boomlet.utils.aggregators import to_aggregator
+from boomlet.utils.collection import GroupBy, sorted_lookup
 from boomlet.utils.matrix_decoders import to_decoder
 
 
@@ -149,17 +148,16 @@ class DiscreteConstantPredictor(BaseEstimator, TransformerMixin):
 
     def fit(self, X, y):
         assert len(X.shape) == 1
-        enumerated_y = list(enumerate(y))
-        grouped = group_by(enumerated_y, lambda i: X[i[0]])
-        aggregator = to_aggregator(self.aggregator)
-        self.value_map_ = {}
-        for k, v in grouped.items():
-            self.value_map_[k] = aggregator(np.array([i[1] for i in v]))
+        groups = GroupBy(X)
+        self.keys_ = groups.keys
+        self.values_ = groups.aggregate(y, self.aggregator)
+        self.value_map_ = dict(zip(self.keys_, self.values_))
         return self
 
     def transform(self, X):
         assert len(X.shape) == 1
-        return np.array([self.value_map_.get(x, 0) for x in X])
+        groups = sorted_lookup(self.keys_, X)
+        return np.where(groups >= 0, self.values_[groups], 0)
 
 
 class DiscreteOrdinalPredictor(BaseEstimator, TransformerMixin):
@@ -25,3 +25,200 @@ def to_aggregator(aggregator):
         return from_str(aggregator)
     else:
         return aggregator
+
+
+def _promote(value, batch):
+    """ value cast to a dtype that also holds batch (e.g. float after an int array is followed by a float batch), so that it can be updated in place
+    """
+    dtype = np.result_type(value, batch)
+    if dtype != value.dtype:
+        value = value.astype(dtype)
+    return value
+
+
+class RunningSum(object):
+
+    """ elementwise sum of a stream of same-shaped arrays, as np.sum of them stacked along axis 0
+    """
+
+    def __init__(self):
+        self.total = None
+
+    def update(self, batch):
+        if self.total is None:
+            self.total = np.array(batch)
+            if self.total.dtype.kind == "b":
+                # np.sum counts booleans
+                self.total = self.total.astype(int)
+        else:
+            self.total = _promote(self.total, batch)
+            self.total += batch
+        return self
+
+    def result(self):
+        return self.total
+
+
+class RunningMean(object):
+
+    """ elementwise mean of a stream of same-shaped arrays, as np.mean of them stacked along axis 0
+    """
+
+    def __init__(self):
+        self.total = None
+        self.count = 0
+
+    def update(self, batch):
+        if self.total is None:
+            self.total = np.array(batch, dtype=float)
+        else:
+            self.total += batch
+        self.count += 1
+        return self
+
+    def result(self):
+        return self.total / self.count
+
+
+class RunningMin(object):
+
+    """ elementwise min of a stream of same-shaped arrays, as np.min of them stacked along axis 0
+    """
+
+    def __init__(self):
+        self.value = None
+
+    def update(self, batch):
+        if self.value is None:
+            self.value = np.array(batch)
+        else:
+            self.value = _promote(self.value, batch)
+            np.minimum(self.value, batch, out=self.value)
+        return self
+
+    def result(self):
+        return self.value
+
+
+class RunningMax(object):
+
+    """ elementwise max of a stream of same-shaped arrays, as np.max of them stacked along axis 0
+    """
+
+    def __init__(self):
+        self.value = None
+
+    def update(self, batch):
+        if self.value is None:
+            self.value = np.array(batch)
+        else:
+            self.value = _promote(self.value, batch)
+            np.maximum(self.value, batch, out=self.value)
+        return self
+
+    def result(self):
+        return self.value
+
+
+class StreamingMode(object):
+
+    """ elementwise mode of a stream of same-shaped arrays of labels, the smallest label on ties as with scipy.stats.mode
+
+    keeps a count per element and label seen, updated with bincount
+    """
+
+    def __init__(self):
+        self.labels = None
+        self.counts = None
+
+    def update(self, batch):
+        batch = np.asarray(batch)
+        if self.labels is None:
+            self.labels = np.unique(batch)
+            self.counts = np.zeros((batch.size, len(self.labels)), dtype=np.int64)
+            self.shape = batch.shape
+        new_labels = np.setdiff1d(batch, self.labels)
+        if len(new_labels):
+            labels = np.union1d(self.labels, new_labels)
+            counts = np.zeros((self.counts.shape[0], len(labels)), dtype=np.int64)
+            counts[:, np.searchsorted(labels, self.labels)] = self.counts
+            self.labels, self.counts = labels, counts
+        n_labels = len(self.labels)
+        codes = np.searchsorted(self.labels, batch.ravel())
+        flat = np.arange(batch.size) * n_labels + codes
+        self.counts += np.bincount(flat, minlength=batch.size * n_labels).reshape(-1, n_labels)
+        return self
+
+    def result(self):
+        return self.labels[np.argmax(self.counts, axis=1)].reshape(self.shape)
+
+
+class StreamingMedian(object):
+
+    """ approximate elementwise median of a stream of same-shaped arrays, with the remedian: https://www.jstor.org/stable/2289867
+
+    arrays are buffered base at a time, and each full buffer is replaced by its median in the buffer of the next level, so at most base arrays per level are kept; the median is exact for up to base arrays
+    """
+
+    def __init__(self, base=11):
+        self.base = base
+        self.buffers = [[]]
+
+    def update(self, batch):
+        self.buffers[0].append(np.array(batch, dtype=float))
+        level = 0
+        while len(self.buffers[level]) == self.base:
+            median = np.median(self.buffers[level], axis=0)
+            self.buffers[level] = []
+            level += 1
+            if level == len(self.buffers):
+                self.buffers.append([])
+            self.buffers[level].append(median)
+        return self
+
+    def result(self):
+        """ weighted median of the buffered arrays, where an array at a level stands for base ** level arrays
+        """
+        values = []
+        weights = []
+        for level, buffer in enumerate(self.buffers):
+            values.extend(buffer)
+            weights.extend([self.base ** level] * len(buffer))
+        shape = values[0].shape
+        values = np.array(values).reshape(len(values), -1)
+        columns = np.arange(values.shape[1])
+        order = np.argsort(values, axis=0, kind='mergesort')
+        cumulative = np.cumsum(np.array(weights, dtype=float)[order], axis=0)
+        half = cumulative[-1] / 2.0
+        # the mean of the values at which the cumulative weight reaches and
+        # passes half the total weight, as np.median for equal weights
+        lower = order[np.argmax(cumulative >= half, axis=0), columns]
+        upper = order[np.argmax(cumulative > half, axis=0), columns]
+        median = (values[lower, columns] + values[upper, columns]) / 2.0
+        return median.reshape(shape)
+
+
+RUNNING_AGGREGATORS = {
+    "mean": RunningMean,
+    "mode": StreamingMode,
+    "median": StreamingMedian,
+    "max": RunningMax,
+    "min": RunningMin,
+    "sum": RunningSum,
+}
+
+
+def to_running_aggregator(aggregator, dtype=None):
+    """ a new running aggregator for a name or a function of AGGREGATORS, or None if there is none for the aggregator
+
+    there is none for the mode of floats (e.g. probabilities), since it would keep a count for every distinct value
+    """
+    if not isinstance(aggregator, str):
+        for name, func in AGGREGATORS.items():
+            if aggregator is func:
+                aggregator = name
+    if not (isinstance(aggregator, str) and aggregator in RUNNING_AGGREGATORS):
+        return None
+    if aggregator == "mode" and dtype is not None and np.dtype(dtype).kind in "fc":
+        return None
+    return RUNNING_AGGREGATORS[aggregator]()
@@ -1,6 +1,12 @@
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import hashlib
 import itertools
 
 import numpy as np
+import scipy.sparse
 
 
 def _to_2d(m):
@@ -26,18 +32,129 @@ def to_2d(*Xs):
         raise Exception("to_2d can't be called with no arguments")
 
 
-def column_combinations(*Xs):
+def _column(X, i):
+    if scipy.sparse.issparse(X):
+        return X[:, i].toarray().ravel()
+    return X[:, i]
+
+
+def iter_column_combinations(*Xs):
+    """
+    generator of the columns of column_combinations(*Xs) in blocks of
+    (index of the first column, block), so that the combinations can be
+    streamed through without materializing all of them
+
+    each block is the last input multiplied by one combination of columns
+    of the other inputs, and is sparse if any input is sparse
+    """
+    assert len(Xs) > 1
+    is_sparse = any(scipy.sparse.issparse(X) for X in Xs)
+    Xs = [X.tocsc() if scipy.sparse.issparse(X) else _to_2d(X) for X in Xs]
+    heads, last = Xs[:-1], Xs[-1]
+    if is_sparse:
+        last = scipy.sparse.csc_matrix(last)
+    width = last.shape[1]
+    head_columns = itertools.product(*[range(X.shape[1]) for X in heads])
+    for block, indices in enumerate(head_columns):
+        prefix = _column(heads[0], indices[0])
+        for X, i in zip(heads[1:], indices[1:]):
+            prefix = prefix * _column(X, i)
+        if is_sparse:
+            yield block * width, scipy.sparse.diags(prefix).dot(last).tocsc()
+        else:
+            yield block * width, last * prefix.reshape(-1, 1)
+
+
+def _sparse_column_combinations(Xs):
+    """
+    column_combinations of inputs some of which are sparse, as a csc matrix
+    whose data and indices are allocated once, after counting the nonzeros
+    of each block in a first pass, and filled block by block
+    """
+    Xs = [X.tocsc() if scipy.sparse.issparse(X) else _to_2d(X) for X in Xs]
+    heads, last = Xs[:-1], scipy.sparse.csc_matrix(Xs[-1])
+    width = last.shape[1]
+    n_blocks = int(np.prod([X.shape[1] for X in heads]))
+    dtype = np.result_type(*[X.dtype for X in Xs])
+
+    def block_values():
+        # values of the nonzeros of last in each block
+        for indices in itertools.product(*[range(X.shape[1]) for X in heads]):
+            prefix = _column(heads[0], indices[0])
+            for X, i in zip(heads[1:], indices[1:]):
+                prefix = prefix * _column(X, i)
+            yield (last.data * prefix[last.indices]).astype(dtype, copy=False)
+
+    nnz = sum(np.count_nonzero(values) for values in block_values())
+    shape = (last.shape[0], n_blocks * width)
+    index_dtype = np.int32 if max(nnz, shape[0]) < 2 ** 31 else np.int64
+    data = np.empty(nnz, dtype=dtype)
+    indices = np.empty(nnz, dtype=index_dtype)
+    indptr = np.zeros(shape[1] + 1, dtype=index_dtype)
+    pos = 0
+    for block, values in enumerate(block_values()):
+        keep = values != 0
+        kept = np.concatenate([[0], np.cumsum(keep)])
+        n = kept[-1]
+        data[pos:pos + n] = values[keep]
+        indices[pos:pos + n] = last.indices[keep]
+        indptr[block * width + 1:(block + 1) * width + 1] = pos + kept[last.indptr[1:]]
+        pos += n
+    return scipy.sparse.csc_matrix((data, indices, indptr), shape=shape)
+
+
+def column_combinations(*Xs, **kwargs):
     """
     creates a feature for each column combination in Xs
 
     e.g. for column a in A, column b in B, and column c in C,
     a * b * c will be in column_combinations(A, B, C)
+
+    the result is a csc matrix if any input is sparse, which is assembled
+    without holding the blocks in memory besides it; otherwise it is written
+    block by block into the array out if given (e.g. a memmap from
+    numpy.lib.format.open_memmap), else into a .npy memmap at filename if
+    given, else into a new array
     """
+    out = kwargs.pop("out", None)
+    filename = kwargs.pop("filename", None)
+    if kwargs:
+        raise TypeError("Improper arguments: {}".format(list(kwargs)))
     assert len(Xs) > 1
+    if any(scipy.sparse.issparse(X) for X in Xs):
+        if out is not None or filename is not None:
+            raise ValueError("Improper arguments: out and filename require dense inputs")
+        return _sparse_column_combinations(Xs)
+    blocks = iter_column_combinations(*Xs)
+    shape = (Xs[0].shape[0], int(np.prod([_to_2d(X).shape[1] for X in Xs])))
+    if out is None:
+        dtype = np.result_type(*Xs)
+        if filename is not None:
+            out = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape)
+        else:
+            out = np.empty(shape, dtype=dtype)
+    elif out.shape != shape:
+        raise Exception("Improper output shape: {} instead of {}".format(out.shape, shape))
+    for start, block in blocks:
+        out[:, start:start + block.shape[1]] = block
+    return out
 
-    def col_generator(X):
-        for col in X.T:
-            yield col
 
-    generator = itertools.product(*map(col_generator, Xs))
-    return to_2d(*[np.product(cols, axis=0) for cols in generator])
+def array_hash(X, sample_size=None):
+    """
+    hex digest of the shape, dtype and contents of an array
+
+    if sample_size is given, only that many evenly spaced elements are
+    hashed, which is much faster for large arrays but misses changes to
+    the other elements
+    """
+    X = np.asarray(X)
+    h = hashlib.md5()
+    h.update(repr((X.shape, X.dtype.str)).encode())
+    if sample_size is not None and X.size > sample_size:
+        X = X.flat[np.linspace(0, X.size - 1, sample_size).astype(np.intp)]
+    if X.dtype.hasobject:
+        h.update(pickle.dumps(X, pickle.HIGHEST_PROTOCOL))
+    else:
+        h.update(np.ascontiguousarray(X).data)
+    return h.hexdigest()
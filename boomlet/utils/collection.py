@@ -1,6 +1,10 @@
 import itertools
 from collections import defaultdict
 
+import numpy as np
+
+from boomlet.utils import aggregators
+
 
 def grouper(n, iterable, fillvalue=None):
     """ groups an iterable into chunks of a certain size
@@ -19,3 +23,133 @@ def group_by(coll, key_fn):
     for v in coll:
         out[key_fn(v)].append(v)
     return dict(out)
+
+
+def sorted_lookup(sorted_keys, keys):
+    """ index of each key in an array of sorted unique keys, or -1 for keys that aren't in it
+    """
+    keys = np.asarray(keys)
+    if not len(sorted_keys):
+        return -np.ones(keys.shape, dtype=np.intp)
+    positions = np.searchsorted(sorted_keys, keys)
+    positions[positions == len(sorted_keys)] = 0
+    return np.where(sorted_keys[positions] == keys, positions, -1)
+
+
+class GroupBy(object):
+
+    """ vectorized group by of an array of keys: rows are sorted by key once, so that the indices of each group are a contiguous slice of that order, and reductions of values by group are computed without Python loops over rows
+
+    Example:
+
+    groups = GroupBy(X[:, 0])
+    for key, indices in groups:
+        clfs[key] = clf.fit(X[indices], y[indices])
+    means = groups.mean(y)  # aligned with groups.keys
+    """
+
+    # reductions that have vectorized implementations
+    REDUCTIONS = ("mean", "median", "mode", "sum", "count", "min", "max")
+
+    def __init__(self, keys):
+        keys = np.asarray(keys)
+        if (keys.dtype.kind in "iu" and len(keys)
+                and keys.min() >= 0 and keys.max() < 2 * len(keys)):
+            # small non-negative integers are grouped in linear time
+            present = np.bincount(keys) > 0
+            self.keys = np.nonzero(present)[0].astype(keys.dtype)
+            self.inverse = (np.cumsum(present) - 1)[keys]
+        else:
+            self.keys, self.inverse = np.unique(keys, return_inverse=True)
+        self.counts = np.bincount(self.inverse, minlength=len(self.keys))
+        self.starts = np.concatenate([[0], np.cumsum(self.counts)[:-1]]).astype(np.intp)
+        self._order = None
+
+    @property
+    def order(self):
+        """ row indices sorted by group, stable within groups
+        """
+        if self._order is None:
+            self._order = np.argsort(self.inverse, kind='mergesort')
+        return self._order
+
+    def __len__(self):
+        return len(self.keys)
+
+    def indices(self, group):
+        """ indices of the rows of the group with index group (in self.keys)
+        """
+        start = self.starts[group]
+        return self.order[start:start + self.counts[group]]
+
+    def __iter__(self):
+        for group, key in enumerate(self.keys):
+            yield key, self.indices(group)
+
+    def to_dict(self):
+        """ same as group_by over the row indices
+        """
+        return dict(iter(self))
+
+    def lookup(self, keys):
+        """ index of the group of each key, or -1 for keys that aren't in any group
+        """
+        return sorted_lookup(self.keys, keys)
+
+    def _sorted(self, values):
+        return np.asarray(values)[self.order]
+
+    def count(self, values=None):
+        return self.counts
+
+    def sum(self, values):
+        values = np.asarray(values)
+        if values.ndim == 1:
+            return np.bincount(self.inverse, weights=values, minlength=len(self.keys))
+        return np.add.reduceat(self._sorted(values), self.starts, axis=0)
+
+    def mean(self, values):
+        sums = self.sum(values)
+        return sums / self.counts.reshape((-1,) + (1,) * (sums.ndim - 1))
+
+    def min(self, values):
+        return np.minimum.reduceat(self._sorted(values), self.starts, axis=0)
+
+    def max(self, values):
+        return np.maximum.reduceat(self._sorted(values), self.starts, axis=0)
+
+    def median(self, values):
+        """ median of 1D values of each group
+        """
+        values = np.asarray(values)
+        # values sorted within each group
+        sorted_values = values[np.lexsort((values, self.inverse))]
+        lower = sorted_values[self.starts + (self.counts - 1) // 2]
+        upper = sorted_values[self.starts + self.counts // 2]
+        return (lower + upper) / 2.0
+
+    def mode(self, values):
+        """ most frequent of 1D values of each group, the smallest one on ties (as scipy.stats.mode)
+        """
+        unique_values, value_inverse = np.unique(np.asarray(values), return_inverse=True)
+        pairs = self.inverse.astype(np.int64) * len(unique_values) + value_inverse
+        unique_pairs, pair_counts = np.unique(pairs, return_counts=True)
+        pair_groups = unique_pairs // len(unique_values)
+        pair_values = unique_pairs % len(unique_values)
+        # for each group, the most frequent and then smallest value comes first
+        order = np.lexsort((pair_values, -pair_counts, pair_groups))
+        first = order[np.concatenate([[True], np.diff(pair_groups[order]) != 0])]
+        return unique_values[pair_values[first]]
+
+    def aggregate(self, values, aggregator):
+        """ reduces values by group with an aggregator (a name or function as accepted by aggregators.to_aggregator), vectorized for the names in REDUCTIONS and the matching functions of aggregators.AGGREGATORS
+        """
+        if not isinstance(aggregator, str):
+            for name, func in aggregators.AGGREGATORS.items():
+                if aggregator is func:
+                    aggregator = name
+        if isinstance(aggregator, str) and aggregator in self.REDUCTIONS:
+            return getattr(self, aggregator)(values)
+        aggregator = aggregators.to_aggregator(aggregator)
+        values = np.asarray(values)
+        return np.array([aggregator(values[indices]) for _, indices in self])
@@ -1,8 +1,13 @@
 import math
-from copy import deepcopy
+import numbers
 import numpy as np
+from sklearn.base import clone
 from sklearn.cross_validation import ShuffleSplit
 from sklearn.preprocessing import LabelBinarizer
+from sklearn.utils import check_random_state
+
+from boomlet.decorators import memoize
+from boomlet.parallel import pmap
 
 
 def flexible_int(size, in_val=None):
@@ -28,11 +33,40 @@ def flexible_int(size, in_val=None):
 
 
 def fit_predict(clf, X, y, X_test):
-    tmp_clf = deepcopy(clf)
+    # a new estimator with the same params, even if clf is already fit
+    tmp_clf = clone(clf, safe=False)
     tmp_clf.fit(X, y)
     return tmp_clf.predict(X_test)
 
 
+def _shuffle_splits(n, n_iter, test_size, random_state):
+    cv = ShuffleSplit(n,
+                      n_iter=n_iter,
+                      test_size=test_size,
+                      random_state=random_state,
+    )
+    return [(train, test) for train, test in cv]
+
+
+# splits with the same integer random_state are the same, so they are
+# computed once for all the candidates scored with it
+_cached_shuffle_splits = memoize(max_bytes=1e8)(_shuffle_splits)
+
+
+def cv_splits(n, n_iter=3, test_size=0.1, random_state=None):
+    """ list of (train indices, test indices) of a ShuffleSplit, shared by calls with the same integer random_state
+    """
+    if isinstance(random_state, numbers.Integral):
+        return _cached_shuffle_splits(n, n_iter, test_size, random_state)
+    return _shuffle_splits(n, n_iter, test_size, random_state)
+
+
+def _fold_score(clf, X, y, score_func, split):
+    train, test = split
+    preds = fit_predict(clf, X[train], y[train], X[test])
+    return score_func(y[test], preds)
+
+
 def quick_cv(clf,
              X,
              y,
@@ -40,18 +74,9 @@ def quick_cv(clf,
              n_iter=3,
              test_size=0.1,
              random_state=None):
-    """ returns the cross validation """
-    cv = ShuffleSplit(y.shape[0],
-                      n_iter=n_iter,
-                      test_size=test_size,
-                      random_state=random_state,
-    )
-    scores = []
-    for train, test in cv:
-        X_train, X_test = X[train], X[test]
-        y_train, y_test = y[train], y[test]
-        preds = fit_predict(clf, X_train, y_train, X_test)
-        scores.append(score_func(y_test, preds))
+    """ returns the cross validation score, fitting folds in parallel """
+    splits = cv_splits(y.shape[0], n_iter, test_size, random_state)
+    scores = pmap(_fold_score, splits, clf, X, y, score_func)
     return sum(scores) / float(len(scores))
 
 
@@ -71,20 +96,102 @@ def quick_score(clf,
         return quick_cv(clf, X, y, score_func, n_iter, test_size, random_state)
 
 
-def gaussian_kernel_median_trick(X, sample_size='sqrt'):
+def _pairwise_sq_dist_tiles(sample, rows):
+    """ yields row blocks of the squared euclidean distances between the rows of a sample
+    """
+    sq_norms = np.sum(sample ** 2, axis=1)
+    for start in range(0, sample.shape[0], rows):
+        stop = start + rows
+        dist = np.dot(sample[start:stop], sample.T)
+        dist *= -2
+        dist += sq_norms[start:stop, np.newaxis]
+        dist += sq_norms
+        # rounding can make the distance of a row to itself negative
+        np.maximum(dist, 0, out=dist)
+        yield dist
+
+
+def _blocked_select(make_tiles, ranks, below, inside, lo, hi, tol,
+                    max_elements, bins):
+    """ values of the given ranks among the values of the tiles, of which below are smaller than lo and inside are between lo and hi
+    """
+    while True:
+        if inside <= max_elements:
+            values = np.concatenate([tile[(tile >= lo) & (tile <= hi)]
+                                     for tile in make_tiles()])
+            kth = [rank - below for rank in ranks]
+            return list(np.partition(values, kth)[kth])
+        if hi - lo <= tol * abs(hi):
+            return [(lo + hi) / 2.0] * len(ranks)
+        counts = np.zeros(bins, dtype=np.int64)
+        for tile in make_tiles():
+            tile_counts, edges = np.histogram(tile, bins=bins, range=(lo, hi))
+            counts += tile_counts
+        cumulative = below + np.cumsum(counts)
+        positions = np.searchsorted(cumulative, ranks, side='right')
+        if len(set(positions)) > 1:
+            # the ranks are narrowed down separately from here on
+            return sum([_blocked_select(make_tiles,
+                                        [rank],
+                                        cumulative[pos] - counts[pos],
+                                        counts[pos],
+                                        edges[pos],
+                                        edges[pos + 1],
+                                        tol,
+                                        max_elements,
+                                        bins)
+                        for rank, pos in zip(ranks, positions)], [])
+        pos = positions[0]
+        if (edges[pos], edges[pos + 1]) == (lo, hi):
+            # the range can't be narrowed at floating point precision
+            return [(lo + hi) / 2.0] * len(ranks)
+        below = cumulative[pos] - counts[pos]
+        inside = counts[pos]
+        lo, hi = edges[pos], edges[pos + 1]
+
+
+def blocked_median(make_tiles, n, tol=1e-3, max_elements=1e7, bins=1024):
+    """
+    median of the n values of the arrays yielded by make_tiles() (which is
+    called once per pass over the values), with at most max_elements values
+    in memory besides the tiles
+
+    the range of the median is narrowed with histograms, until the values in
+    it fit in memory and the median is exact, or the range is within a
+    relative tolerance of tol and its center is returned
+    """
+    lo, hi = np.inf, -np.inf
+    for tile in make_tiles():
+        lo = min(lo, tile.min())
+        hi = max(hi, tile.max())
+    # the median is the mean of the values of these ranks
+    ranks = sorted(set([(n - 1) // 2, n // 2]))
+    return np.mean(_blocked_select(make_tiles, ranks, 0, n, lo, hi, tol,
+                                   max_elements, bins))
+
+
+def gaussian_kernel_median_trick(X, sample_size='sqrt', random_state=None,
+                                 tol=1e-3, max_bytes=1e8):
     """
     From: http://www.machinedlearnings.com/2013/08/cosplay.html
 
     estimate a kernel bandwidth using the "median trick"
     this is a standard Gaussian kernel technique
+
+    the pairwise distances of the sample are computed in tiles of at most
+    max_bytes, so the median is exact if the distances fit in max_bytes,
+    else within a relative error of tol
     """
     sample_size = flexible_int(X.shape[0], sample_size)
-    perm = np.random.permutation(np.arange(X.shape[0]))
-    sample = X[perm[:sample_size]]
-    norms = np.sum(sample ** 2, axis=1).reshape(-1, 1)
-    tmp = np.dot(norms, np.ones((1, sample_size)))
-    dist = tmp + tmp.T - 2 * np.dot(sample, sample.T)
-    scale = 1 / np.sqrt(np.median(dist))
+    perm = check_random_state(random_state).permutation(X.shape[0])
+    sample = X[perm[:sample_size]].astype(float)
+    # each tile has a same-sized temporary
+    rows = max(1, int(max_bytes // (2 * 8 * sample_size)))
+    median = blocked_median(lambda: _pairwise_sq_dist_tiles(sample, rows),
+                            sample_size ** 2,
+                            tol=tol,
+                            max_elements=max_bytes // 16)
+    scale = 1 / np.sqrt(median)
     return scale
 
 
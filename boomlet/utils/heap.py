@@ -1,5 +1,7 @@
 import heapq
 
+import numpy as np
+
 
 class Heap(object):
 
@@ -74,6 +76,115 @@ class Heap(object):
         return repr(self.heap)
 
 
+class IndexedHeap(object):
+
+    """ min heap of unique hashable items that keeps the position of each item, so that membership is O(1) and removing an item or changing its key is O(log n)
+
+    keys are key(item) (or the items themselves if key is None) unless given explicitly
+    """
+
+    def __init__(self, to_heap=None, key=None):
+        self.key = key
+        self.keys = []
+        self.items = []
+        self.positions = {}
+        for item in (to_heap or []):
+            if item in self.positions:
+                raise Exception("Improper duplicate item: {}".format(item))
+            self.positions[item] = len(self.items)
+            self.keys.append(self._key(item))
+            self.items.append(item)
+        for pos in reversed(range(len(self.items) // 2)):
+            self._sift_down(pos)
+
+    def _key(self, item):
+        return item if self.key is None else self.key(item)
+
+    def _swap(self, i, j):
+        self.keys[i], self.keys[j] = self.keys[j], self.keys[i]
+        self.items[i], self.items[j] = self.items[j], self.items[i]
+        self.positions[self.items[i]] = i
+        self.positions[self.items[j]] = j
+
+    def _sift_up(self, pos):
+        # moves an item towards the root while it is smaller than its parent
+        while pos > 0:
+            parent = (pos - 1) // 2
+            if not self.keys[pos] < self.keys[parent]:
+                break
+            self._swap(pos, parent)
+            pos = parent
+
+    def _sift_down(self, pos):
+        # moves an item towards the leaves while it is larger than a child
+        size = len(self.keys)
+        while True:
+            smallest = pos
+            for child in (2 * pos + 1, 2 * pos + 2):
+                if child < size and self.keys[child] < self.keys[smallest]:
+                    smallest = child
+            if smallest == pos:
+                return
+            self._swap(pos, smallest)
+            pos = smallest
+
+    def push(self, item, key=None):
+        if item in self.positions:
+            raise Exception("Improper push of item already in heap: {}".format(item))
+        self.positions[item] = len(self.items)
+        self.keys.append(self._key(item) if key is None else key)
+        self.items.append(item)
+        self._sift_up(len(self.items) - 1)
+
+    def peek(self):
+        return self.items[0]
+
+    # note: this raises IndexError if heap is empty
+    def pop(self):
+        item = self.items[0]
+        self.remove(item)
+        return item
+
+    def remove(self, item):
+        pos = self.positions[item]
+        last = len(self.items) - 1
+        if pos != last:
+            self._swap(pos, last)
+        self.keys.pop()
+        self.items.pop()
+        del self.positions[item]
+        if pos != last:
+            self._sift_up(pos)
+            self._sift_down(pos)
+
+    def update_key(self, item, new_key):
+        pos = self.positions[item]
+        old_key = self.keys[pos]
+        self.keys[pos] = new_key
+        if new_key < old_key:
+            self._sift_up(pos)
+        elif old_key < new_key:
+            self._sift_down(pos)
+
+    def get_key(self, item):
+        return self.keys[self.positions[item]]
+
+    def __contains__(self, item):
+        return item in self.positions
+
+    def __len__(self):
+        return len(self.items)
+
+    def size(self):
+        return len(self.items)
+
+    def __str__(self):
+        return str(list(zip(self.keys, self.items)))
+
+    def __repr__(self):
+        return repr(list(zip(self.keys, self.items)))
+
+
 class ConstSizeHeap(object):
 
     def __init__(self, max_size, key=None):
@@ -85,6 +196,10 @@ class ConstSizeHeap(object):
         while self.heap.size() > self.max_size:
             self.heap.pop()
 
+    def push_many(self, scores, items):
+        for item in zip(scores, items):
+            self.push(item)
+
     def pop(self):
         return self.heap.pop()
 
@@ -96,3 +211,79 @@ class ConstSizeHeap(object):
 
     def __repr__(self):
         return repr(self.heap)
+
+
+class TopK(object):
+
+    """ keeps the max_size (score, item) pairs with the largest numeric scores, with the scores in a float array
+
+    can replace a ConstSizeHeap of (score, item) pairs; pairs with a score not larger than the smallest kept score of a full container are dropped right away, and the others are buffered and selected with argpartition once max_size of them are buffered
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.scores = np.empty(0)
+        self.items = []
+        self.pending_scores = []
+        self.pending_items = []
+        # scores not larger than this can't be kept
+        self.threshold = -np.inf
+
+    def push(self, item):
+        score, value = item
+        if score <= self.threshold:
+            return
+        self.pending_scores.append(score)
+        self.pending_items.append(value)
+        if len(self.pending_scores) >= self.max_size:
+            self._compact()
+
+    def push_many(self, scores, items):
+        scores = np.asarray(scores, dtype=float)
+        keep = np.nonzero(scores > self.threshold)[0]
+        items = list(items)
+        self._compact(scores[keep], [items[i] for i in keep])
+
+    def _compact(self, new_scores=(), new_items=()):
+        scores = np.concatenate([self.scores, self.pending_scores, new_scores])
+        items = self.items + self.pending_items + list(new_items)
+        self.pending_scores = []
+        self.pending_items = []
+        if len(scores) > self.max_size:
+            keep = np.argpartition(-scores, self.max_size - 1)[:self.max_size]
+            scores = scores[keep]
+            items = [items[i] for i in keep]
+        self.scores = scores
+        self.items = items
+        if len(scores) == self.max_size:
+            self.threshold = scores.min()
+
+    def pop(self):
+        """ removes and returns the pair with the smallest score
+        """
+        self._compact()
+        i = np.argmin(self.scores)
+        item = (float(self.scores[i]), self.items.pop(i))
+        self.scores = np.delete(self.scores, i)
+        self.threshold = -np.inf
+        return item
+
+    def to_list(self):
+        """ list of the (score, item) pairs sorted by decreasing score
+        """
+        self._compact()
+        order = np.argsort(-self.scores, kind='mergesort')
+        return [(float(self.scores[i]), self.items[i]) for i in order]
+
+    def size(self):
+        # every pending pair is kept until max_size pairs are kept
+        return min(self.max_size, len(self.scores) + len(self.pending_scores))
+
+    def __len__(self):
+        return self.size()
+
+    def __str__(self):
+        return str(self.to_list())
+
+    def __repr__(self):
+        return repr(self.to_list())
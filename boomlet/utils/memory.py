@@ -0,0 +1,51 @@
+import os
+import resource
+
+
+def total_memory():
+    """ bytes of physical memory of the machine
+    """
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def _status_bytes(field):
+    """ reads a field in kB from /proc/self/status, returning None if it isn't available
+    """
+    try:
+        with open("/proc/self/status") as infile:
+            for line in infile:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+
+def _max_rss():
+    # ru_maxrss is in kB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def current_rss():
+    """ bytes of resident memory of this process
+    """
+    rss = _status_bytes("VmRSS")
+    return _max_rss() if rss is None else rss
+
+
+def peak_rss():
+    """ bytes of peak resident memory of this process, since it started or since the last reset_peak_rss
+    """
+    peak = _status_bytes("VmHWM")
+    return _max_rss() if peak is None else peak
+
+
+def reset_peak_rss():
+    """ resets the peak resident memory to the current one, returning whether it is supported (linux 4.0+)
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as outfile:
+            outfile.write("5")
+        return True
+    except IOError:
+        return False